@@ -1,22 +1,82 @@
 from os import getenv, urandom
 
-from flask import Flask
+from flask import Flask, Response, jsonify, abort
 from flask_httpauth import HTTPBasicAuth
 from flask_sqlalchemy import SQLAlchemy
 
 from utils import generate_password
+from utils.database import engine_options, configure_sqlite
 
 DATABASE_URL = getenv("DOM_DB_URL", "sqlite:///dom.db")
-SECRET_KEY = getenv("DOM_SECRET_KEY", "2137".hex())
+DB_POOL_SIZE = int(getenv("DOM_DB_POOL_SIZE", 10))
+DB_MAX_OVERFLOW = int(getenv("DOM_DB_MAX_OVERFLOW", 20))
+DB_POOL_RECYCLE = int(getenv("DOM_DB_POOL_RECYCLE", 1800))
+DB_BUSY_TIMEOUT = int(getenv("DOM_DB_BUSY_TIMEOUT", 30))
+SECRET_KEY = getenv("DOM_SECRET_KEY", "2137".encode().hex())
 
 USERNAME = getenv("DOM_USERNAME", "admin")
-PASSWORD = getenv("DOM_PASSWORD") or generate_password()
+PASSWORD = getenv("DOM_PASSWORD")
+
+POLL_INTERVAL = int(getenv("DOM_POLL_INTERVAL", 60))
+POLL_WORKERS = int(getenv("DOM_POLL_WORKERS", 32))
+POLL_TIMEOUT = int(getenv("DOM_POLL_TIMEOUT", 10))
+BULK_WORKERS = int(getenv("DOM_BULK_WORKERS", 16))
+BULK_TIMEOUT = int(getenv("DOM_BULK_TIMEOUT", 300))
+JOB_WORKERS = int(getenv("DOM_JOB_WORKERS", 8))
+JOB_HISTORY = int(getenv("DOM_JOB_HISTORY", 200))
+JOB_OUTPUT_LINES = int(getenv("DOM_JOB_OUTPUT_LINES", 1000))
+JOB_STALE_AFTER = int(getenv("DOM_JOB_STALE_AFTER", 6 * 60 * 60))
+AUTH_CACHE_SIZE = int(getenv("DOM_AUTH_CACHE_SIZE", 1024))
+AUTH_CACHE_TTL = int(getenv("DOM_AUTH_CACHE_TTL", 300))
+HISTORY_RAW_DAYS = int(getenv("DOM_HISTORY_RAW_DAYS", 7))
+HISTORY_HOURLY_DAYS = int(getenv("DOM_HISTORY_HOURLY_DAYS", 90))
+HISTORY_DAILY_DAYS = int(getenv("DOM_HISTORY_DAILY_DAYS", 730))
+HISTORY_COMPACT_INTERVAL = int(getenv("DOM_HISTORY_COMPACT_INTERVAL", 60 * 60))
+PROFILING = getenv("DOM_PROFILING", "0") == "1"
+SLOW_REQUEST_MS = int(getenv("DOM_SLOW_REQUEST_MS", 1000))
+PROFILE_SAMPLE_RATE = float(getenv("DOM_PROFILE_SAMPLE_RATE", 0))
+PROFILE_STORE_SIZE = int(getenv("DOM_PROFILE_STORE_SIZE", 20))
+SCHEDULER_INTERVAL = int(getenv("DOM_SCHEDULER_INTERVAL", 30))
+SCHEDULE_RUN_DAYS = int(getenv("DOM_SCHEDULE_RUN_DAYS", 90))
+LEADER_LEASE = int(getenv("DOM_LEADER_LEASE", 300))
+FORM_OPTIONS_TTL = int(getenv("DOM_FORM_OPTIONS_TTL", 60))
+OPERATIONS_CACHE_SIZE = int(getenv("DOM_OPERATIONS_CACHE_SIZE", 4096))
+OPERATIONS_CACHE_TTL = int(getenv("DOM_OPERATIONS_CACHE_TTL", 300))
+IMPORT_BATCH_SIZE = int(getenv("DOM_IMPORT_BATCH_SIZE", 100))
+DRAFT_TTL = int(getenv("DOM_DRAFT_TTL", 24 * 60 * 60))
+BATCH_STEPS = getenv("DOM_BATCH_STEPS", "1") == "1"
+SSH_MAX_PER_HOST = int(getenv("DOM_SSH_MAX_PER_HOST", 4))
+SSH_IDLE_TIMEOUT = int(getenv("DOM_SSH_IDLE_TIMEOUT", 300))
+SSH_KEEPALIVE = int(getenv("DOM_SSH_KEEPALIVE", 30))
+SSH_CONNECT_TIMEOUT = int(getenv("DOM_SSH_CONNECT_TIMEOUT", 10))
+SSH_KNOWN_HOSTS = getenv("DOM_SSH_KNOWN_HOSTS")
+SSH_AUTO_ADD_HOST_KEYS = getenv("DOM_SSH_AUTO_ADD_HOST_KEYS", "0") == "1"
+KEY_CACHE_SIZE = int(getenv("DOM_KEY_CACHE_SIZE", 256))
+KEY_CACHE_TTL = int(getenv("DOM_KEY_CACHE_TTL", 600))
+WOL_BROADCASTS = getenv("DOM_WOL_BROADCASTS", "255.255.255.255").split(",")
+WOL_PORT = int(getenv("DOM_WOL_PORT", 9))
+WOL_RETRIES = int(getenv("DOM_WOL_RETRIES", 3))
+# Windows hosts aren't probed unless configured, e.g. "windows:5985" for
+# WinRM, because they don't all listen on the same port.
+REACH_PORTS = {
+    name: int(port)
+    for name, port in (
+        item.split(":") for item in getenv("DOM_REACH_PORTS", "linux:22").split(",")
+    )
+}
+REACH_TIMEOUT = float(getenv("DOM_REACH_TIMEOUT", 1))
+REACH_DOWN_TTL = int(getenv("DOM_REACH_DOWN_TTL", 30))
+REACH_WORKERS = int(getenv("DOM_REACH_WORKERS", 32))
 
 app = Flask(__name__)
 app.config["SECRET_KEY"] = SECRET_KEY
 app.config["MAX_CONTENT_LENGTH"] = 20 * 1000 * 1000
 app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URL
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(
+    DATABASE_URL, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_RECYCLE, DB_BUSY_TIMEOUT
+)
+configure_sqlite(DB_BUSY_TIMEOUT)
 
 db = SQLAlchemy(app)
 auth = HTTPBasicAuth()
@@ -26,25 +86,90 @@ auth = HTTPBasicAuth()
 def authenticate(username, password):
     if not (username and password):
         return False
-    # TODO: sprawdzić z użytkownikiem z bazy + dodać haszowanie jak chcemy
-    return (username == USERNAME) and (password == PASSWORD)
+    return verify_user(username, password)
 
 
 # TODO: tu zaimportować blueprinty (https://flask.palletsprojects.com/en/2.2.x/blueprints/)
+from controller.api import api
 from controller.credential import credentials
 from controller.custom_operation import custom_operations
+from controller.job import jobs
 from controller.machine import machines
+from controller.schedule import schedules
+from controller.transfer import transfer
+from utils.auth import ensure_admin, verify_user
+from utils.metrics import registry, instrument_app
+from utils.search import ensure_indexes
+from utils.profiling import request_profiler
+from utils.session import DraftSessionInterface
 
 db.create_all()
+ensure_indexes()
+ensure_admin(USERNAME, PASSWORD)
+
+app.session_interface = DraftSessionInterface(DRAFT_TTL)
+instrument_app(app)
+request_profiler.init_app(app)
+registry.gauge(
+    "dom_db_connections_checked_out",
+    "Database connections currently in use.",
+    lambda: db.engine.pool.checkedout(),
+)
 
+app.register_blueprint(api)
 app.register_blueprint(credentials)
 app.register_blueprint(custom_operations)
+app.register_blueprint(jobs)
 app.register_blueprint(machines)
+app.register_blueprint(schedules)
+app.register_blueprint(transfer)
+
+from utils.poller import status_poller
+from utils.scheduler import scheduler
+
+if POLL_INTERVAL:
+    status_poller.start()
+if SCHEDULER_INTERVAL:
+    scheduler.start()
+
+
+@app.cli.command("create-admin")
+def create_admin():
+    password = PASSWORD or generate_password()
+    ensure_admin(USERNAME, password)
+    if not PASSWORD:
+        print(f"Password of '{USERNAME}': {password}")
+
 
 @app.route("/info/health")
 def healthcheck():
     return "", 204
 
 
+@app.route("/info/metrics")
+def metrics():
+    return registry.render(), 200, {"Content-Type": "text/plain; version=0.0.4"}
+
+
+@app.route("/info/profiles")
+@auth.login_required
+def profiles():
+    return jsonify(
+        [{"id": id, "path": path} for id, path in request_profiler.store.list()]
+    )
+
+
+@app.route("/info/profiles/<profile_id>")
+@auth.login_required
+def download_profile(profile_id):
+    _, stats = request_profiler.store.get(profile_id) or abort(404)
+    disposition = f"attachment; filename={profile_id}.prof"
+    return Response(
+        stats,
+        mimetype="application/octet-stream",
+        headers={"Content-Disposition": disposition},
+    )
+
+
 if __name__ == "__main__":
-    app.run(debug=True)
\ No newline at end of file
+    app.run(debug=True)
@@ -0,0 +1,221 @@
+import argparse
+import json
+import os
+import sys
+from base64 import b64encode
+from statistics import quantiles
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+USERNAME = "bench"
+PASSWORD = "bench"
+
+
+def configure(directory):
+    # The app reads its configuration on import, so this has to run first.
+    os.environ["DOM_DB_URL"] = f"sqlite:///{os.path.join(directory, 'bench.db')}"
+    os.environ["DOM_USERNAME"] = USERNAME
+    os.environ["DOM_PASSWORD"] = PASSWORD
+    os.environ["DOM_POLL_INTERVAL"] = "0"
+    os.environ["DOM_SCHEDULER_INTERVAL"] = "0"
+    sys.path.insert(0, ROOT)
+
+
+def seed(machines, credentials, custom_ops, ops_per_machine):
+    from app import db
+    from model.credential import Password
+    from model.custom_operation import CustomOperation
+    from model.hardware_features import WakeOnLan
+    from model.machine import Machine
+    from model.software_platform import LinuxPlatform, WindowsPlatform
+
+    creds = [
+        Password(name=f"credential-{i}", username="root", secret="secret")
+        for i in range(credentials)
+    ]
+    ops = [
+        CustomOperation(
+            name=f"operation-{i}",
+            description=f"Benchmark operation {i}",
+            ops=[{"op_name": "run_command", "argument": f"echo {i}"}],
+        )
+        for i in range(custom_ops)
+    ]
+    db.session.add_all(creds + ops)
+    db.session.commit()
+
+    for i in range(machines):
+        platform = LinuxPlatform if i % 3 else WindowsPlatform
+        db.session.add(
+            Machine(
+                name=f"machine-{i:05d}",
+                place=f"room-{i % 20}",
+                hardware_features=(
+                    WakeOnLan(
+                        mac_address=f"02:00:00:00:{i // 256 % 256:02x}:{i % 256:02x}"
+                    )
+                    if i % 2
+                    else None
+                ),
+                software_platforms=[
+                    platform(
+                        hostname=f"host-{i}.example", credential=creds[i % credentials]
+                    )
+                ],
+                custom_operations=[
+                    ops[(i + j) % custom_ops] for j in range(ops_per_machine)
+                ],
+            )
+        )
+        if i % 500 == 499:
+            db.session.commit()
+    db.session.commit()
+
+
+class StubProvider:
+    PROVIDER_NAME = "stub"
+
+    def __init__(self, ops):
+        self.ops = ops
+
+    def get_operations(self):
+        return self.ops
+
+
+def measure(name, func, iterations, warmup=5):
+    for _ in range(warmup):
+        func(0)
+    timings = []
+    for i in range(iterations):
+        started = perf_counter()
+        func(i)
+        timings.append(perf_counter() - started)
+
+    cuts = quantiles(timings, n=100, method="inclusive")
+    return {
+        "name": name,
+        "iterations": iterations,
+        "ops_per_sec": round(iterations / sum(timings), 1),
+        "p50_ms": round(cuts[49] * 1000, 3),
+        "p90_ms": round(cuts[89] * 1000, 3),
+        "p99_ms": round(cuts[98] * 1000, 3),
+        "max_ms": round(max(timings) * 1000, 3),
+    }
+
+
+def run(args):
+    from app import app, db
+    from controller.machine import (
+        machine_schema,
+        hardware_features_schema,
+        software_platform_schema,
+    )
+    from model.base import BASIC_OPS
+    from model.machine import Machine
+    from utils import execute_operations
+
+    client = app.test_client()
+    token = b64encode(f"{USERNAME}:{PASSWORD}".encode()).decode()
+    headers = {"Authorization": f"Basic {token}"}
+    pages = -(-args.machines // 20)
+
+    def machines_page(i):
+        response = client.get(f"/?page={i % pages + 1}", headers=headers)
+        assert response.status_code == 200, response.status_code
+
+    def edit_machine(i):
+        # Alternating machines makes every request rebuild the session draft.
+        response = client.get(f"/edit_machine/{i % args.machines + 1}", headers=headers)
+        assert response.status_code == 200, response.status_code
+
+    with app.app_context():
+        machines = Machine.query.limit(100).all()
+        payloads = [
+            {
+                "name": f"loaded-{m.id}",
+                "place": m.place,
+                "hardware_features": (
+                    hardware_features_schema.dump(m.hardware_features)
+                    if m.hardware_features
+                    else None
+                ),
+                "software_platforms": software_platform_schema.dump(
+                    m.software_platforms, many=True
+                ),
+                "custom_operations": [op.id for op in m.custom_operations],
+            }
+            for m in machines
+        ]
+
+        def schema_dump(i):
+            m = machines[i % len(machines)]
+            if m.hardware_features:
+                hardware_features_schema.dump(m.hardware_features)
+            software_platform_schema.dump(m.software_platforms, many=True)
+
+        def schema_load(i):
+            with db.session.no_autoflush:
+                machine_schema.load(payloads[i % len(payloads)])
+            db.session.rollback()
+
+        stub = StubProvider(
+            {op.name: (lambda *args: None, op.description) for op in BASIC_OPS}
+        )
+        steps = [
+            {"op_name": op.name, "argument": "true" if op.with_argument else None}
+            for op in BASIC_OPS
+        ]
+        dispatched = machines[0]
+        dispatched.get_operation_providers = lambda: [stub]
+
+        def dispatch(i):
+            execute_operations(dispatched, steps)
+
+        results = [
+            measure("schema_dump", schema_dump, args.iterations * 10),
+            measure("schema_load", schema_load, args.iterations * 10),
+            measure("execute_operations", dispatch, args.iterations * 10),
+        ]
+
+    results[:0] = [
+        measure("all_machines", machines_page, args.iterations),
+        measure("edit_machine", edit_machine, args.iterations),
+    ]
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark routes and dispatch.")
+    parser.add_argument("--machines", type=int, default=2000)
+    parser.add_argument("--credentials", type=int, default=20)
+    parser.add_argument("--custom-ops", type=int, default=50)
+    parser.add_argument("--ops-per-machine", type=int, default=3)
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    with TemporaryDirectory(prefix="dom-bench-") as directory:
+        configure(directory)
+        started = perf_counter()
+        seed(args.machines, args.credentials, args.custom_ops, args.ops_per_machine)
+        seeded = perf_counter() - started
+        results = run(args)
+
+    if args.json:
+        print(json.dumps({"machines": args.machines, "results": results}, indent=2))
+        return
+    print(f"Seeded {args.machines} machines in {seeded:.1f}s")
+    print(
+        f"{'benchmark':<20}{'n':>8}{'ops/s':>12}{'p50 ms':>10}"
+        f"{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}"
+    )
+    for r in results:
+        print(
+            f"{r['name']:<20}{r['iterations']:>8}{r['ops_per_sec']:>12}"
+            f"{r['p50_ms']:>10}{r['p90_ms']:>10}{r['p99_ms']:>10}{r['max_ms']:>10}"
+        )
+
+
+if __name__ == "__main__":
+    main()
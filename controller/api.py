@@ -0,0 +1,450 @@
+from datetime import datetime, timedelta
+
+from flask import Blueprint, request, jsonify, abort
+from marshmallow import ValidationError, EXCLUDE
+from sqlalchemy.exc import IntegrityError
+
+from app import db, auth, BULK_WORKERS, BULK_TIMEOUT
+from controller.credential import credential_schema
+from controller.custom_operation import custom_op_schema, operation_schema
+from controller.machine import (
+    machine_schema,
+    hardware_features_schema,
+    software_platform_schema,
+    update_machine_fields,
+    with_relationships,
+    form_options_cache,
+    operations_cache,
+    available_operations,
+    RELATIONSHIPS,
+)
+from controller.transfer import KINDS, import_records, export_response
+from model.base import MachineStatus
+from model.credential import Credential
+from model.custom_operation import CustomOperation
+from model.machine import Machine
+from utils.fleet import save_statuses
+from utils.history import delete_history, uptime
+from utils.jobs import Job, FleetJob, job_queue
+from utils.reachability import reachability, HostUnreachable
+from utils.search import filter_machines, sort_machines, sort_cursor, after_sort_cursor
+from utils.ssh import ssh_pool
+from utils.transfer import check_format, read_records
+
+api = Blueprint("api", __name__, url_prefix="/api/v1")
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 500
+DEFAULT_UPTIME_DAYS = 30
+
+MACHINE_FIELDS = {
+    "id": lambda m: m.id,
+    "name": lambda m: m.name,
+    "place": lambda m: m.place,
+    "last_status": lambda m: m.last_status.value if m.last_status else None,
+    "last_status_time": lambda m: (
+        m.last_status_time.isoformat() if m.last_status_time else None
+    ),
+    "hardware_features": lambda m: (
+        hardware_features_schema.dump(m.hardware_features)
+        if m.hardware_features
+        else None
+    ),
+    "software_platforms": lambda m: software_platform_schema.dump(
+        m.software_platforms, many=True
+    ),
+    "custom_operations": lambda m: [op.id for op in m.custom_operations],
+}
+
+CREDENTIAL_FIELDS = {
+    "id": lambda c: c.id,
+    "name": lambda c: c.name,
+    "type": lambda c: c.PROVIDER_NAME,
+    "username": lambda c: c.username,
+    "key_type": lambda c: getattr(c, "key_type", None),
+}
+
+CUSTOM_OPERATION_FIELDS = {
+    "id": lambda o: o.id,
+    "name": lambda o: o.name,
+    "description": lambda o: o.description,
+    "ops": lambda o: o.ops,
+}
+
+
+class ApiError(Exception):
+    def __init__(self, status, errors):
+        self.status = status
+        self.errors = errors
+
+
+@api.errorhandler(ApiError)
+def api_error(e):
+    return jsonify(errors=e.errors), e.status
+
+
+@api.errorhandler(ValidationError)
+def validation_error(e):
+    db.session.rollback()
+    return jsonify(errors=e.messages), 400
+
+
+@api.errorhandler(IntegrityError)
+def integrity_error(e):
+    db.session.rollback()
+    return jsonify(errors=["Object with this name already exists"]), 409
+
+
+@api.errorhandler(404)
+def not_found(e):
+    return jsonify(errors=["Not found"]), 404
+
+
+def requested_fields(getters):
+    if not request.args.get("fields"):
+        return list(getters)
+    fields = request.args["fields"].split(",")
+    if unknown := [name for name in fields if name not in getters]:
+        raise ApiError(400, [f"Unknown field '{name}'" for name in unknown])
+    return ["id"] + [name for name in fields if name != "id"]
+
+
+def dump(obj, getters, fields=None):
+    return {name: getters[name](obj) for name in fields or getters}
+
+
+def get_limit():
+    try:
+        limit = int(request.args.get("limit", DEFAULT_LIMIT))
+    except ValueError:
+        raise ApiError(400, ["Field 'limit' must be an integer"])
+    if limit < 1:
+        raise ApiError(400, ["Field 'limit' must be at least 1"])
+    return min(limit, MAX_LIMIT)
+
+
+def list_objects(query, model, getters):
+    fields = requested_fields(getters)
+    limit = get_limit()
+    try:
+        cursor = int(request.args.get("cursor", 0))
+    except ValueError:
+        raise ApiError(400, ["Field 'cursor' must be an integer"])
+
+    # Keyset pagination, the cursor is the last id of the previous page.
+    items = query.filter(model.id > cursor).order_by(model.id).limit(limit + 1).all()
+    next_cursor = items[limit - 1].id if len(items) > limit else None
+    return jsonify(
+        items=[dump(item, getters, fields) for item in items[:limit]],
+        next_cursor=next_cursor,
+    )
+
+
+def get_json():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        raise ApiError(400, ["Request body must be a JSON object"])
+    return data
+
+
+def get_time(name):
+    if not request.args.get(name):
+        return None
+    try:
+        return datetime.fromisoformat(request.args[name])
+    except ValueError:
+        raise ApiError(400, [f"Field '{name}' must be an ISO 8601 date"])
+
+
+@api.route("/machines", methods=["GET"])
+@auth.login_required
+def list_machines():
+    fields = requested_fields(MACHINE_FIELDS)
+    query = with_relationships(
+        Machine.query, [name for name in RELATIONSHIPS if name in fields]
+    )
+    sort = request.args.get("sort")
+    try:
+        query = filter_machines(query, request.args)
+        if not sort:
+            return list_objects(query, Machine, MACHINE_FIELDS)
+        query = sort_machines(query, sort)
+        if request.args.get("cursor"):
+            query = after_sort_cursor(query, sort, request.args["cursor"])
+    except ValueError as e:
+        raise ApiError(400, [str(e)])
+
+    limit = get_limit()
+    items = query.limit(limit + 1).all()
+    next_cursor = sort_cursor(items[limit - 1]) if len(items) > limit else None
+    return jsonify(
+        items=[dump(item, MACHINE_FIELDS, fields) for item in items[:limit]],
+        next_cursor=next_cursor,
+    )
+
+
+@api.route("/machines/<int:machine_id>", methods=["GET"])
+@auth.login_required
+def get_machine(machine_id):
+    machine = Machine.query.get_or_404(machine_id)
+    return jsonify(dump(machine, MACHINE_FIELDS, requested_fields(MACHINE_FIELDS)))
+
+
+@api.route("/machines", methods=["POST"])
+@auth.login_required
+def create_machine():
+    data = {"custom_operations": []} | get_json()
+    machine = machine_schema.load(data, unknown=EXCLUDE)
+    db.session.add(machine)
+    db.session.commit()
+    form_options_cache.invalidate()
+    return jsonify(dump(machine, MACHINE_FIELDS)), 201
+
+
+@api.route("/machines/<int:machine_id>", methods=["PUT"])
+@auth.login_required
+def update_machine(machine_id):
+    machine = Machine.query.get_or_404(machine_id)
+    data = get_json()
+    if errors := machine_schema.validate(data, partial=("custom_operations",)):
+        raise ApiError(400, errors)
+    update_machine_fields(machine, data)
+    db.session.commit()
+    form_options_cache.invalidate()
+    reachability.forget_machine(machine)
+    return jsonify(dump(machine, MACHINE_FIELDS))
+
+
+@api.route("/machines/<int:machine_id>", methods=["DELETE"])
+@auth.login_required
+def delete_machine(machine_id):
+    machine = Machine.query.get_or_404(machine_id)
+    delete_history(machine.id)
+    db.session.delete(machine)
+    db.session.commit()
+    form_options_cache.invalidate()
+    return "", 204
+
+
+@api.route("/machines/<int:machine_id>/status", methods=["POST"])
+@auth.login_required
+def change_machine_status(machine_id):
+    machine = Machine.query.get_or_404(machine_id)
+    try:
+        target_status = MachineStatus[get_json().get("target_status")]
+    except KeyError:
+        raise ApiError(400, ["Field 'target_status': Incorrect status"])
+
+    try:
+        new_status = reachability.check_machine(machine, target_status)
+    except HostUnreachable as e:
+        raise ApiError(503, [str(e)])
+    if new_status is None:
+        new_status = machine.ensure_status(target_status)
+        if new_status == MachineStatus.POWER_ON:
+            reachability.forget_machine(machine)
+    save_statuses({machine.id: new_status})
+    return jsonify(status=new_status.value, success=new_status == target_status)
+
+
+@api.route("/machines/<int:machine_id>/uptime", methods=["GET"])
+@auth.login_required
+def get_machine_uptime(machine_id):
+    machine = Machine.query.get_or_404(machine_id)
+    until = get_time("until") or datetime.now()
+    since = get_time("since") or until - timedelta(days=DEFAULT_UPTIME_DAYS)
+
+    return jsonify(
+        machine_id=machine.id,
+        since=since.isoformat(),
+        until=until.isoformat(),
+        **uptime(machine.id, since, until),
+    )
+
+
+@api.route("/machines/<int:machine_id>/operations", methods=["GET"])
+@auth.login_required
+def get_machine_operations(machine_id):
+    machine = Machine.query.get_or_404(machine_id)
+    return jsonify(machine_id=machine.id, operations=available_operations(machine))
+
+
+@api.route("/machines/<int:machine_id>/jobs", methods=["POST"])
+@auth.login_required
+def execute_machine_action(machine_id):
+    machine = Machine.query.get_or_404(machine_id)
+    steps = operation_schema.load(get_json().get("steps", []), many=True)
+    if not steps:
+        raise ApiError(400, ["Field 'steps': At least one step is required"])
+    available_ops = available_operations(machine)
+    if unknown := [s["op_name"] for s in steps if s["op_name"] not in available_ops]:
+        raise ApiError(
+            400,
+            [
+                f"Operation '{name}' is not available on this machine"
+                for name in unknown
+            ],
+        )
+
+    job = job_queue.submit(Job(machine.id, machine.name, steps))
+    return jsonify(job.to_dict()), 202
+
+
+@api.route("/credentials", methods=["GET"])
+@auth.login_required
+def list_credentials():
+    return list_objects(Credential.query, Credential, CREDENTIAL_FIELDS)
+
+
+@api.route("/credentials/<int:credential_id>", methods=["GET"])
+@auth.login_required
+def get_credential(credential_id):
+    credential = Credential.query.get_or_404(credential_id)
+    return jsonify(
+        dump(credential, CREDENTIAL_FIELDS, requested_fields(CREDENTIAL_FIELDS))
+    )
+
+
+@api.route("/credentials", methods=["POST"])
+@auth.login_required
+def create_credential():
+    credential = credential_schema.load(get_json(), unknown=EXCLUDE)
+    db.session.add(credential)
+    db.session.commit()
+    form_options_cache.invalidate()
+    return jsonify(dump(credential, CREDENTIAL_FIELDS)), 201
+
+
+@api.route("/credentials/<int:credential_id>", methods=["PUT"])
+@auth.login_required
+def update_credential(credential_id):
+    previous = Credential.query.get_or_404(credential_id)
+    data = {"type": previous.PROVIDER_NAME} | get_json()
+    if not data.get("key"):
+        data["key"] = previous.key
+        data["key_type"] = previous.key_type
+    if ("secret" not in data) and getattr(previous, "secret", None):
+        data["secret"] = previous.secret
+
+    updated = credential_schema.load(data, unknown=EXCLUDE)
+    updated.id = credential_id
+    if previous.type != updated.type:
+        raise ApiError(400, ["Changing credential type is not allowed"])
+
+    updated = db.session.merge(updated)
+    db.session.commit()
+    form_options_cache.invalidate()
+    ssh_pool.invalidate(updated.id)
+    return jsonify(dump(updated, CREDENTIAL_FIELDS))
+
+
+@api.route("/credentials/<int:credential_id>", methods=["DELETE"])
+@auth.login_required
+def delete_credential(credential_id):
+    credential = Credential.query.get_or_404(credential_id)
+    db.session.delete(credential)
+    db.session.commit()
+    form_options_cache.invalidate()
+    ssh_pool.invalidate(credential_id)
+    return "", 204
+
+
+@api.route("/custom_operations", methods=["GET"])
+@auth.login_required
+def list_custom_operations():
+    return list_objects(CustomOperation.query, CustomOperation, CUSTOM_OPERATION_FIELDS)
+
+
+@api.route("/custom_operations/<int:custom_operation_id>", methods=["GET"])
+@auth.login_required
+def get_custom_operation(custom_operation_id):
+    custom_operation = CustomOperation.query.get_or_404(custom_operation_id)
+    fields = requested_fields(CUSTOM_OPERATION_FIELDS)
+    return jsonify(dump(custom_operation, CUSTOM_OPERATION_FIELDS, fields))
+
+
+@api.route("/custom_operations", methods=["POST"])
+@auth.login_required
+def create_custom_operation():
+    custom_operation = custom_op_schema.load(get_json(), unknown=EXCLUDE)
+    db.session.add(custom_operation)
+    db.session.commit()
+    form_options_cache.invalidate()
+    return jsonify(dump(custom_operation, CUSTOM_OPERATION_FIELDS)), 201
+
+
+@api.route("/custom_operations/<int:custom_operation_id>", methods=["PUT"])
+@auth.login_required
+def update_custom_operation(custom_operation_id):
+    CustomOperation.query.get_or_404(custom_operation_id)
+    updated = custom_op_schema.load(get_json(), unknown=EXCLUDE)
+    updated.id = custom_operation_id
+    updated = db.session.merge(updated)
+    db.session.commit()
+    form_options_cache.invalidate()
+    operations_cache.invalidate()
+    return jsonify(dump(updated, CUSTOM_OPERATION_FIELDS))
+
+
+@api.route("/custom_operations/<int:custom_operation_id>", methods=["DELETE"])
+@auth.login_required
+def delete_custom_operation(custom_operation_id):
+    custom_operation = CustomOperation.query.get_or_404(custom_operation_id)
+    db.session.delete(custom_operation)
+    db.session.commit()
+    form_options_cache.invalidate()
+    operations_cache.invalidate()
+    return "", 204
+
+
+@api.route("/custom_operations/<int:custom_operation_id>/jobs", methods=["POST"])
+@auth.login_required
+def run_custom_operation(custom_operation_id):
+    custom_operation = CustomOperation.query.get_or_404(custom_operation_id)
+    machines = dict(
+        db.session.query(Machine.id, Machine.name).filter(
+            Machine.custom_operations.any(CustomOperation.id == custom_operation.id)
+        )
+    )
+    job = job_queue.submit(
+        FleetJob(
+            custom_operation.name,
+            machines,
+            custom_operation.ops,
+            BULK_WORKERS,
+            BULK_TIMEOUT,
+        )
+    )
+    return jsonify(job.to_dict()), 202
+
+
+@api.route("/jobs/<job_id>", methods=["GET"])
+@auth.login_required
+def get_job(job_id):
+    job = job_queue.get(job_id) or abort(404)
+    return jsonify(job.to_dict())
+
+
+@api.route(
+    "/<any(machines, credentials, custom_operations):kind>/import", methods=["POST"]
+)
+@auth.login_required
+def import_objects(kind):
+    format = request.args.get("format", "json")
+    try:
+        check_format(format)
+        report = import_records(
+            KINDS[kind], read_records(request.stream, format), format
+        )
+    except ValueError as e:
+        raise ApiError(400, [str(e)])
+    return jsonify(report)
+
+
+@api.route("/<any(machines, credentials, custom_operations):kind>/export")
+@auth.login_required
+def export_objects(kind):
+    try:
+        return export_response(kind, request.args.get("format", "json"))
+    except ValueError as e:
+        raise ApiError(400, [str(e)])
@@ -6,6 +6,7 @@ from marshmallow_oneofschema import OneOfSchema
 from sqlalchemy.exc import IntegrityError
 
 from app import db, auth
+from controller.machine import form_options_cache
 from model.credential import (
     Credential,
     Password,
@@ -13,6 +14,7 @@ from model.credential import (
     SshKeyWithPassword,
     SshCredential,
 )
+from utils.ssh import ssh_pool
 
 credentials = Blueprint("credentials", __name__, template_folder="templates")
 
@@ -105,6 +107,8 @@ def delete_credential(credential_id):
     credential = Credential.query.get_or_404(credential_id)
     db.session.delete(credential)
     db.session.commit()
+    ssh_pool.invalidate(credential.id)
+    form_options_cache.invalidate()
     message = f"Successfully deleted '{credential.name}' credential."
     return render_template("success.html", message=message, redirect="/credentials")
 
@@ -125,6 +129,7 @@ def create_credential():
         new_credential = credential_schema.load(form, unknown=EXCLUDE)
         db.session.add(new_credential)
         db.session.commit()
+        form_options_cache.invalidate()
         message = f"Successfully created '{new_credential.name}' credential."
         return render_template("success.html", message=message, redirect="/credentials")
     except ValidationError as e:
@@ -172,6 +177,8 @@ def update_credential(credential_id):
 
         db.session.merge(updated)
         db.session.commit()
+        ssh_pool.invalidate(updated.id)
+        form_options_cache.invalidate()
         message = f"Successfully updated '{updated.name}' credential."
         return render_template("success.html", message=message, redirect="/credentials")
     except ValidationError as e:
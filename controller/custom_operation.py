@@ -4,9 +4,16 @@ from marshmallow import fields, post_load, ValidationError, EXCLUDE
 from marshmallow.validate import Length
 from sqlalchemy.exc import IntegrityError
 
-from app import db, auth
+from app import db, auth, BULK_WORKERS, BULK_TIMEOUT
+from controller.machine import (
+    form_options_cache,
+    operations_cache,
+    available_operations,
+)
 from model.base import BASIC_OPS
 from model.custom_operation import CustomOperation
+from model.machine import Machine
+from utils.jobs import FleetJob, job_queue
 
 custom_operations = Blueprint(
     "custom_operations", __name__, template_folder="templates"
@@ -101,12 +108,41 @@ def delete_custom_operation(custom_operation_id):
     custom_operation = CustomOperation.query.get_or_404(custom_operation_id)
     db.session.delete(custom_operation)
     db.session.commit()
+    form_options_cache.invalidate()
+    operations_cache.invalidate()
     message = f"Successfully deleted '{custom_operation.name}' custom operation."
     return render_template(
         "success.html", message=message, redirect="/custom_operations"
     )
 
 
+@custom_operations.route("/run_custom_operation/<custom_operation_id>", methods=["GET"])
+@auth.login_required
+def run_custom_operation(custom_operation_id):
+    custom_operation = CustomOperation.query.get_or_404(custom_operation_id)
+    machines = dict(
+        db.session.query(Machine.id, Machine.name).filter(
+            Machine.custom_operations.any(CustomOperation.id == custom_operation.id)
+        )
+    )
+    if not machines:
+        message = f"No machine has '{custom_operation.name}' custom operation"
+        return render_template(
+            "error.html", message=message, redirect="/custom_operations"
+        )
+
+    job = job_queue.submit(
+        FleetJob(
+            custom_operation.name,
+            machines,
+            custom_operation.ops,
+            BULK_WORKERS,
+            BULK_TIMEOUT,
+        )
+    )
+    return redirect(f"/jobs/{job.id}")
+
+
 ma = Marshmallow()
 
 
@@ -117,9 +153,16 @@ def add_operation_step():
     if "steps" not in session:
         return redirect(redirects[0])
     custom_op = session["steps"]
+    available_ops = None
+    if session.get("action") == "MACHINE_EXECUTE":
+        available_ops = available_operations(Machine.query.get_or_404(session["id"]))
 
     try:
         new_step = operation_schema.load(request.form, unknown=EXCLUDE)
+        if (available_ops is not None) and (new_step["op_name"] not in available_ops):
+            raise ValidationError(
+                {"op_name": ["Operation is not available on this machine"]}
+            )
         if new_step["op_name"] not in (op.name for op in BASIC_OPS if op.with_argument):
             new_step["argument"] = None
 
@@ -135,6 +178,8 @@ def add_operation_step():
                 redirects[1],
                 custom_op=custom_op,
                 basic_ops=BASIC_OPS,
+                steps=custom_op,
+                available_ops=available_ops,
                 errors=errors,
             ),
             200,
@@ -174,6 +219,7 @@ def create_custom_operation():
         new_custom_op = custom_op_schema.load(new_custom_op, unknown=EXCLUDE)
         db.session.add(new_custom_op)
         db.session.commit()
+        form_options_cache.invalidate()
 
         session.clear()
         message = f"Successfully created '{new_custom_op.name}' custom operation."
@@ -224,6 +270,8 @@ def update_custom_operation(custom_operations_id):
         updated.id = int(custom_operations_id)
         db.session.merge(updated)
         db.session.commit()
+        form_options_cache.invalidate()
+        operations_cache.invalidate()
 
         session.clear()
         message = f"Successfully updated '{updated.name}' custom operation."
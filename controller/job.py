@@ -0,0 +1,83 @@
+import json
+from time import sleep
+
+from flask import render_template, Blueprint, Response, request, jsonify, abort
+
+from app import auth
+from utils.jobs import FleetJob, job_queue
+
+jobs = Blueprint("jobs", __name__, template_folder="templates")
+
+KEEPALIVE_INTERVAL = 15
+STORED_POLL_INTERVAL = 2
+
+
+@jobs.route("/jobs/<job_id>")
+@auth.login_required
+def job_details(job_id):
+    job = job_queue.get(job_id) or abort(404)
+    if isinstance(job, FleetJob):
+        return render_template("fleet_job.html", job=job), 200
+    return render_template("job.html", job=job), 200
+
+
+@jobs.route("/jobs/<job_id>/status")
+@auth.login_required
+def job_status(job_id):
+    job = job_queue.get(job_id) or abort(404)
+    return jsonify(job.to_dict())
+
+
+def job_events(job, after):
+    while True:
+        events, dropped, closed = job.log.read(after, KEEPALIVE_INTERVAL)
+        if dropped:
+            yield f"event: dropped\ndata: {json.dumps({'events': dropped})}\n\n"
+        for id, event, data in events:
+            yield f"id: {id}\nevent: {event}\ndata: {json.dumps(data)}\n\n"
+            after = id
+        if closed and not events:
+            return
+        if not (events or dropped):
+            yield ": keepalive\n\n"
+
+
+def stored_job_events(job_id):
+    # The job runs in another worker, its steps are followed in the database
+    # and their output shows up when the page reloads at the end.
+    statuses = {}
+    while True:
+        job = job_queue.load(job_id)
+        if job is None:
+            return
+        changed = [
+            step for step in job.steps if statuses.get(step.index) != step.status
+        ]
+        for step in changed:
+            statuses[step.index] = step.status
+            yield f"event: step\ndata: {json.dumps(step.to_event())}\n\n"
+        if job.is_finished:
+            yield f"event: end\ndata: {json.dumps({'status': job.status.value})}\n\n"
+            return
+        if not changed:
+            yield ": keepalive\n\n"
+        sleep(STORED_POLL_INTERVAL)
+
+
+@jobs.route("/jobs/<job_id>/stream")
+@auth.login_required
+def job_stream(job_id):
+    job = job_queue.get(job_id) or abort(404)
+    if isinstance(job, FleetJob):
+        abort(404)
+    if job_queue.is_local(job_id):
+        # EventSource sends the last seen id when it reconnects.
+        after = request.headers.get("Last-Event-ID", -1, type=int)
+        events = job_events(job, after)
+    else:
+        events = stored_job_events(job_id)
+    return Response(
+        events,
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -1,30 +1,60 @@
+from collections import namedtuple
 from datetime import datetime
 from functools import partial
 
 from flask import render_template, Blueprint, request, session, redirect
 from flask_marshmallow import Marshmallow
-from marshmallow import fields, post_load, ValidationError, EXCLUDE
+from marshmallow import fields, post_load, validates, ValidationError, EXCLUDE
 from marshmallow.validate import Length, Regexp
 from marshmallow_oneofschema import OneOfSchema
 from sqlalchemy.exc import IntegrityError
-
-from app import db, auth
+from sqlalchemy.orm import selectinload, joinedload
+
+from app import (
+    db,
+    auth,
+    BULK_WORKERS,
+    BULK_TIMEOUT,
+    FORM_OPTIONS_TTL,
+    OPERATIONS_CACHE_SIZE,
+    OPERATIONS_CACHE_TTL,
+)
 from model.base import MachineStatus
 from model.credential import Credential
 from model.custom_operation import CustomOperation
 from model.hardware_features import WakeOnLan, LibvirtGuest
 from model.machine import Machine
 from model.software_platform import LinuxPlatform, WindowsPlatform
-from utils import execute_operations, display_duration
+from utils import display_duration
+from utils.cache import MemoryCache
+from utils.fleet import ensure_statuses, save_statuses
+from utils.history import delete_history
+from utils.metrics import timed_operation
+from utils.profiling import profiled
+from utils.jobs import Job, job_queue
+from utils.poller import status_poller
+from utils.reachability import reachability, HostUnreachable
+from utils.search import filter_machines, sort_machines, FILTERS
 
 machines = Blueprint("machines", __name__, template_folder="templates")
 
+RELATIONSHIPS = ("hardware_features", "software_platforms", "custom_operations")
+
 REDIRECTS = {
     "ADD": lambda: ("/add_machine", "add_machine.html"),
     "EDIT": lambda id: (f"/edit_machine/{id}", "edit_machine.html"),
     "EXECUTE": lambda id: (f"/execute_action/{id}", "execute_action.html"),
 }
 
+FormOption = namedtuple("FormOption", ["id", "name", "description"])
+
+# Option lists for the add/edit machine forms. Each gunicorn worker keeps
+# its own copy, the TTL bounds how long other workers can lag behind.
+form_options_cache = MemoryCache(ttl=FORM_OPTIONS_TTL)
+# Operations each machine offers as {name: description}, keyed by the
+# machine's providers, so every worker misses at once when they change.
+operations_cache = MemoryCache(maxsize=OPERATIONS_CACHE_SIZE, ttl=OPERATIONS_CACHE_TTL)
+
 ma = Marshmallow()
 
 
@@ -88,6 +118,12 @@ class SoftwarePlatformSchema(OneOfSchema):
         return obj.PROVIDER_NAME
 
 
+def custom_operations_by_id(ids):
+    return {
+        op.id: op for op in CustomOperation.query.filter(CustomOperation.id.in_(ids))
+    }
+
+
 class MachineSchema(ma.Schema):
     name = fields.Str(required=True, validate=Length(max=127))
     place = fields.Str(validate=Length(max=127))
@@ -95,11 +131,26 @@ class MachineSchema(ma.Schema):
     software_platforms = fields.List(fields.Nested(SoftwarePlatformSchema))
     custom_operations = fields.List(fields.Integer())
 
+    def custom_operations_by_id(self, ids):
+        # Imports preload every custom operation once and pass them in the
+        # context, everything else looks up only the ones it needs.
+        if "custom_operations" not in self.context:
+            return custom_operations_by_id(ids)
+        known = self.context["custom_operations"]
+        return {id: known[id] for id in ids if id in known}
+
+    @validates("custom_operations")
+    def validate_custom_operations(self, ids):
+        known = self.custom_operations_by_id(ids)
+        if missing := [str(id) for id in ids if id not in known]:
+            raise ValidationError(
+                f"Custom operations do not exist: {', '.join(missing)}"
+            )
+
     @post_load
     def make_machine(self, data, **_):
-        data["custom_operations"] = [
-            CustomOperation.query.get(id) for id in data["custom_operations"]
-        ]
+        known = self.custom_operations_by_id(data["custom_operations"])
+        data["custom_operations"] = [known[id] for id in data["custom_operations"]]
         return Machine(**data)
 
 
@@ -108,13 +159,92 @@ software_platform_schema = SoftwarePlatformSchema()
 machine_schema = MachineSchema()
 
 
+def load_form_options():
+    hosts = LinuxPlatform.query.options(joinedload(LinuxPlatform.machine))
+    return {
+        "custom_ops": [
+            FormOption(op.id, op.name, op.description)
+            for op in CustomOperation.query.all()
+        ],
+        "linux_hosts": [
+            FormOption(host.id, host.machine.name, host.hostname) for host in hosts
+        ],
+        "credentials": {
+            credential.id: FormOption(
+                credential.id, credential.name, credential.READABLE_NAME
+            )
+            for credential in Credential.query.all()
+        },
+    }
+
+
+def form_options():
+    return form_options_cache.get("options", load_form_options)
+
+
+def load_operations(machine):
+    operations = {}
+    # The first provider of an operation is the one which runs it.
+    for provider in reversed(machine.get_operation_providers()):
+        operations |= {
+            name: data[1] for name, data in provider.get_operations().items()
+        }
+    return operations
+
+
+def operations_key(machine):
+    providers = machine.get_operation_providers()
+    return (machine.id, tuple((type(p).__name__, p.id) for p in providers))
+
+
+def available_operations(machine):
+    return operations_cache.get(
+        operations_key(machine), lambda: load_operations(machine)
+    )
+
+
+def with_relationships(query, names=RELATIONSHIPS):
+    # One extra SELECT ... IN per relationship for the whole page instead
+    # of lazy loads for every listed machine.
+    return query.options(*(selectinload(getattr(Machine, name)) for name in names))
+
+
+def update_machine_fields(machine, data):
+    hw = data.get("hardware_features")
+    machine.name = data["name"]
+    machine.place = data.get("place")
+    machine.hardware_features = hardware_features_schema.load(hw) if hw else None
+    machine.software_platforms = software_platform_schema.load(
+        data.get("software_platforms", []), many=True
+    )
+    # The ids were checked by MachineSchema.validate() before.
+    ids = data.get("custom_operations", [])
+    known = custom_operations_by_id(ids)
+    machine.custom_operations = [known[id] for id in ids]
+
+
 @machines.route("/")
 @auth.login_required
 def all_machines():
+    try:
+        query = filter_machines(with_relationships(Machine.query), request.args)
+        query = sort_machines(query, request.args.get("sort"))
+    except ValueError as e:
+        return render_template("error.html", message=str(e), redirect="/")
+
+    search = {name: request.args[name] for name in FILTERS if request.args.get(name)}
+    if request.args.get("sort"):
+        search["sort"] = request.args["sort"]
     return render_template(
         "machines.html",
-        machines=Machine.query.paginate(),
+        machines=query.paginate(),
+        search=search,
+        hardware_types=HardwareFeaturesSchema.type_schemas,
+        platform_types=SoftwarePlatformSchema.type_schemas,
+        statuses=MachineStatus,
         display_duration=partial(display_duration, datetime.now()),
+        last_sweep=status_poller.last_sweep,
+        stale_before=status_poller.stale_before,
     )
 
 
@@ -136,9 +266,7 @@ def add_machine():
         render_template(
             "add_machine.html",
             machine=machine,
-            custom_ops=CustomOperation.query.all(),
-            linux_hosts=LinuxPlatform.query.all(),
-            credentials=Credential.query,
+            **form_options(),
         ),
         200,
     )
@@ -171,9 +299,7 @@ def edit_machine(machine_id):
             name=machine.name,
             place=machine.place,
             providers=providers,
-            custom_ops=CustomOperation.query.all(),
-            linux_hosts=LinuxPlatform.query.all(),
-            credentials=Credential.query,
+            **form_options(),
         ),
         200,
     )
@@ -183,8 +309,10 @@ def edit_machine(machine_id):
 @auth.login_required
 def delete_machine(machine_id):
     machine = Machine.query.get_or_404(machine_id)
+    delete_history(machine.id)
     db.session.delete(machine)
     db.session.commit()
+    form_options_cache.invalidate()
     message = f"Successfully deleted '{machine.name}' machine."
     return render_template("success.html", message=message, redirect="/")
 
@@ -202,14 +330,11 @@ def define_action(machine_id):
         session["steps"] = []
         session["redirect"] = REDIRECTS["EXECUTE"](machine_id)
 
-    available_ops = {}
-    for provider in reversed(machine.get_operation_providers()):
-        available_ops |= provider.get_operations()
     return (
         render_template(
             "execute_action.html",
             steps=session["steps"],
-            available_ops=available_ops,
+            available_ops=available_operations(machine),
         ),
         200,
     )
@@ -222,20 +347,10 @@ def execute_action(machine_id):
         return redirect(f"/execute_action/{machine_id}")
 
     machine = Machine.query.get_or_404(machine_id)
-    steps = session["steps"]
-    try:
-        execute_operations(machine, steps)
-    except Exception as e:
-        message = f"Could not execute action for machine '{machine.name}'"
-        return render_template("error.html", message=message, redirect="/")
-
-    machine.last_status = machine.get_status()
-    machine.last_status_time = datetime.now()
-    db.session.commit()
+    job = job_queue.submit(Job(machine.id, machine.name, session["steps"]))
 
     session.clear()
-    message = f"Successfully executed action for '{machine.name}'"
-    return render_template("success.html", message=message, redirect="/")
+    return redirect(f"/jobs/{job.id}")
 
 
 @machines.route("/clear_action")
@@ -251,11 +366,18 @@ def change_status(machine_id):
     machine = Machine.query.get_or_404(machine_id)
 
     target_status = MachineStatus[request.args.get("target_status")]
-    new_status = machine.ensure_status(target_status)
-
-    machine.last_status = new_status
-    machine.last_status_time = datetime.now()
-    db.session.commit()
+    try:
+        new_status = reachability.check_machine(machine, target_status)
+    except HostUnreachable as e:
+        return render_template("error.html", message=str(e), redirect="/")
+    if new_status is None:
+        features = machine.hardware_features
+        provider = features.PROVIDER_NAME if features else "platform"
+        with timed_operation(provider, "ensure_status"):
+            new_status = machine.ensure_status(target_status)
+        if new_status == MachineStatus.POWER_ON:
+            reachability.forget_machine(machine)
+    save_statuses({machine.id: new_status})
 
     if new_status != target_status:
         message = f"Could not set status for machine '{machine.name}'"
@@ -265,6 +387,39 @@ def change_status(machine_id):
     return render_template("success.html", message=message, redirect="/")
 
 
+@machines.route("/change_status", methods=["POST"])
+@auth.login_required
+def change_status_bulk():
+    try:
+        target_status = MachineStatus[request.form.get("target_status")]
+    except KeyError:
+        return render_template("error.html", message="Incorrect status", redirect="/")
+
+    query = db.session.query(Machine.id, Machine.name)
+    if request.form.get("place"):
+        query = query.filter(Machine.place == request.form["place"])
+    else:
+        ids = [int(id) for id in request.form.getlist("machine_id") if id.isnumeric()]
+        query = query.filter(Machine.id.in_(ids))
+    names = dict(query.all())
+    if not names:
+        message = "No machines were selected"
+        return render_template("error.html", message=message, redirect="/")
+
+    with profiled("provider"):
+        results = ensure_statuses(
+            list(names), target_status, BULK_WORKERS, BULK_TIMEOUT
+        )
+    save_statuses({r.machine_id: r.value for r in results if r.error is None})
+
+    return render_template(
+        "bulk_status.html",
+        target_status=target_status,
+        results=results,
+        names=names,
+    )
+
+
 @machines.route("/add_hardware_features", methods=["POST"])
 @auth.login_required
 def add_hardware_features():
@@ -286,9 +441,7 @@ def add_hardware_features():
             render_template(
                 redirects[1],
                 machine=machine,
-                custom_ops=CustomOperation.query.all(),
-                linux_hosts=LinuxPlatform.query.all(),
-                credentials=Credential.query,
+                **form_options(),
                 errors=errors,
             ),
             200,
@@ -331,9 +484,7 @@ def add_software_platform():
             render_template(
                 redirects[1],
                 machine=machine,
-                custom_ops=CustomOperation.query.all(),
-                linux_hosts=LinuxPlatform.query.all(),
-                credentials=Credential.query,
+                **form_options(),
                 errors=errors,
             ),
             200,
@@ -385,6 +536,7 @@ def create_machine():
         new_machine = machine_schema.load(new_machine, unknown=EXCLUDE)
         db.session.add(new_machine)
         db.session.commit()
+        form_options_cache.invalidate()
 
         session.clear()
         message = f"Successfully created '{new_machine.name}' machine."
@@ -398,9 +550,7 @@ def create_machine():
             render_template(
                 "add_machine.html",
                 machine=machine,
-                custom_ops=CustomOperation.query.all(),
-                linux_hosts=LinuxPlatform.query.all(),
-                credentials=Credential.query,
+                **form_options(),
                 errors=errors,
             ),
             200,
@@ -412,9 +562,7 @@ def create_machine():
             render_template(
                 "add_machine.html",
                 machine=machine,
-                custom_ops=CustomOperation.query.all(),
-                linux_hosts=LinuxPlatform.query.all(),
-                credentials=Credential.query,
+                **form_options(),
                 errors=errors,
             ),
             200,
@@ -441,28 +589,18 @@ def update_machine(machine_id):
                 name=form["name"],
                 place=form["place"],
                 providers=providers,
-                custom_ops=CustomOperation.query.all(),
-                linux_hosts=LinuxPlatform.query.all(),
-                credentials=Credential.query,
+                **form_options(),
                 errors=errors,
             ),
             200,
         )
     else:
         try:
-            machine.name = form["name"]
-            machine.place = form["place"]
-            machine.hardware_features = hardware_features_schema.load(
-                form["hardware_features"]
-            )
-            machine.software_platforms = software_platform_schema.load(
-                form["software_platforms"], many=True
-            )
-            machine.custom_operations = [
-                CustomOperation.query.get(id) for id in form["custom_operations"]
-            ]
+            update_machine_fields(machine, form)
             db.session.commit()
-
+            form_options_cache.invalidate()
+            reachability.forget_machine(machine)
+        
             session.clear()
             message = f"Successfully updated '{machine.name}' machine."
             return render_template("success.html", message=message, redirect="/")
@@ -475,9 +613,7 @@ def update_machine(machine_id):
                     name=form["name"],
                     place=form["place"],
                     providers=providers,
-                    custom_ops=CustomOperation.query.all(),
-                    linux_hosts=LinuxPlatform.query.all(),
-                    credentials=Credential.query,
+                    **form_options(),
                     errors=errors,
                 ),
                 200,
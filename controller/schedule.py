@@ -0,0 +1,132 @@
+from datetime import datetime
+
+from flask import render_template, Blueprint, request
+from flask_marshmallow import Marshmallow
+from marshmallow import fields, post_load, validates, ValidationError, EXCLUDE
+from marshmallow.validate import Length, Range
+from sqlalchemy.exc import IntegrityError
+
+from app import db, auth
+from model.custom_operation import CustomOperation
+from model.machine import Machine
+from model.schedule import Schedule
+from utils.cron import CronSchedule
+
+schedules = Blueprint("schedules", __name__, template_folder="templates")
+
+MAX_JITTER = 24 * 60 * 60
+
+ma = Marshmallow()
+
+
+class ScheduleSchema(ma.Schema):
+    name = fields.String(required=True, validate=Length(min=1, max=127))
+    cron = fields.String(required=True, validate=Length(min=1, max=127))
+    custom_operation_id = fields.Integer(required=True)
+    machine_name = fields.String(load_default="")
+    jitter = fields.Integer(load_default=0, validate=Range(min=0, max=MAX_JITTER))
+
+    @validates("cron")
+    def validate_cron(self, value, **_):
+        try:
+            CronSchedule(value).next_after(datetime.now())
+        except ValueError as e:
+            raise ValidationError(str(e))
+
+    @validates("custom_operation_id")
+    def validate_custom_operation(self, value, **_):
+        if CustomOperation.query.get(value) is None:
+            raise ValidationError("Custom operation does not exist")
+
+    @post_load
+    def make_schedule(self, data, **_):
+        machine_name = data.pop("machine_name").strip()
+        if machine_name:
+            machine = Machine.query.filter_by(name=machine_name).first()
+            if machine is None:
+                raise ValidationError(
+                    f"Machine '{machine_name}' does not exist", "machine_name"
+                )
+            data["machine_id"] = machine.id
+        data["next_run"] = CronSchedule(data["cron"]).next_after(datetime.now())
+        return Schedule(**data)
+
+
+schedule_schema = ScheduleSchema()
+
+
+def _render_add(errors=()):
+    return render_template(
+        "add_schedule.html",
+        custom_operations=CustomOperation.query.order_by(CustomOperation.name).all(),
+        form=request.form,
+        errors=errors,
+    )
+
+
+@schedules.route("/schedules")
+@auth.login_required
+def all_schedules():
+    return render_template(
+        "schedules.html",
+        schedules=Schedule.query.order_by(Schedule.name).paginate(),
+    )
+
+
+@schedules.route("/add_schedule", methods=["GET"])
+@auth.login_required
+def add_schedule():
+    return _render_add(), 200
+
+
+@schedules.route("/add_schedule", methods=["POST"])
+@auth.login_required
+def create_schedule():
+    try:
+        new_schedule = schedule_schema.load(request.form, unknown=EXCLUDE)
+        db.session.add(new_schedule)
+        db.session.commit()
+        message = f"Successfully created '{new_schedule.name}' schedule."
+        return render_template("success.html", message=message, redirect="/schedules")
+    except ValidationError as e:
+        db.session.rollback()
+        errors = [
+            f"Field '{name}': {', '.join(desc)}" for name, desc in e.messages.items()
+        ]
+        return _render_add(errors), 200
+    except IntegrityError:
+        db.session.rollback()
+        return _render_add(["Schedule with this name already exists"]), 200
+
+
+@schedules.route("/schedules/<int:schedule_id>")
+@auth.login_required
+def schedule_runs(schedule_id):
+    schedule = Schedule.query.get_or_404(schedule_id)
+    return render_template(
+        "schedule_runs.html", schedule=schedule, runs=schedule.runs.paginate()
+    )
+
+
+@schedules.route("/toggle_schedule/<int:schedule_id>", methods=["GET"])
+@auth.login_required
+def toggle_schedule(schedule_id):
+    schedule = Schedule.query.get_or_404(schedule_id)
+    schedule.enabled = not schedule.enabled
+    if schedule.enabled:
+        # Runs missed while disabled are not caught up on.
+        schedule.next_run = CronSchedule(schedule.cron).next_after(datetime.now())
+    db.session.commit()
+    state = "enabled" if schedule.enabled else "disabled"
+    message = f"Successfully {state} '{schedule.name}' schedule."
+    return render_template("success.html", message=message, redirect="/schedules")
+
+
+@schedules.route("/delete_schedule/<int:schedule_id>", methods=["GET"])
+@auth.login_required
+def delete_schedule(schedule_id):
+    schedule = Schedule.query.get_or_404(schedule_id)
+    db.session.delete(schedule)
+    db.session.commit()
+    message = f"Successfully deleted '{schedule.name}' schedule."
+    return render_template("success.html", message=message, redirect="/schedules")
@@ -0,0 +1,517 @@
+import csv
+import json
+from functools import cached_property
+
+from flask import (
+    render_template,
+    Blueprint,
+    request,
+    Response,
+    stream_with_context,
+)
+from marshmallow import ValidationError, EXCLUDE
+from sqlalchemy.exc import IntegrityError
+
+from app import db, auth, IMPORT_BATCH_SIZE
+from controller.credential import credential_schema
+from controller.custom_operation import custom_op_schema
+from controller.machine import (
+    MachineSchema,
+    hardware_features_schema,
+    software_platform_schema,
+    with_relationships,
+    form_options_cache,
+    operations_cache,
+)
+from model.credential import Credential
+from model.custom_operation import CustomOperation
+from model.machine import Machine
+from model.software_platform import LinuxPlatform, WindowsPlatform
+from utils.transfer import (
+    FORMATS,
+    check_format,
+    format_from_filename,
+    read_records,
+    write_records,
+    yaml,
+)
+
+transfer = Blueprint("transfer", __name__, template_folder="templates")
+
+PLATFORM_TYPES = [LinuxPlatform, WindowsPlatform]
+
+
+def error_messages(messages, field=None):
+    if isinstance(messages, dict):
+        for name, desc in messages.items():
+            if name == "_schema":
+                name = field
+            elif field is not None:
+                name = f"{field}.{name}"
+            yield from error_messages(desc, name)
+        return
+    if isinstance(messages, str):
+        messages = [messages]
+    if field is None:
+        yield ", ".join(map(str, messages))
+    else:
+        yield f"Field '{field}': {', '.join(map(str, messages))}"
+
+
+def lookup(names, name, field, what, errors):
+    if (not isinstance(name, str)) or (name not in names):
+        errors.setdefault(field, []).append(f"Unknown {what} '{name}'")
+        return None
+    return names[name]
+
+
+class References:
+    # Everything rows refer to by name is read once per import or export
+    # instead of once per row.
+    def __init__(self):
+        self.credentials = dict(db.session.query(Credential.name, Credential.id))
+        self.custom_operations = dict(
+            db.session.query(CustomOperation.name, CustomOperation.id)
+        )
+        self.hosts = dict(
+            db.session.query(Machine.name, LinuxPlatform.id).filter(
+                LinuxPlatform.machine_id == Machine.id
+            )
+        )
+        self.credential_names = {id: name for name, id in self.credentials.items()}
+        self.host_names = {id: name for name, id in self.hosts.items()}
+
+    @cached_property
+    def machine_schema(self):
+        return MachineSchema(
+            context={"custom_operations": {op.id: op for op in CustomOperation.query}}
+        )
+
+
+class MachineTransfer:
+    model = Machine
+    COLUMNS = [
+        "name",
+        "place",
+        "hardware_type",
+        "mac_address",
+        "libvirt_host",
+        "vm_uuid",
+        *(
+            f"{t.PROVIDER_NAME}_{f}"
+            for t in PLATFORM_TYPES
+            for f in ("hostname", "credential")
+        ),
+        "custom_operations",
+    ]
+
+    @staticmethod
+    def query():
+        return with_relationships(Machine.query)
+
+    @staticmethod
+    def from_row(row):
+        hardware = None
+        if row.get("hardware_type"):
+            hardware = {"type": row["hardware_type"]}
+            for column, key in [
+                ("mac_address", "mac_address"),
+                ("libvirt_host", "host"),
+                ("vm_uuid", "vm_uuid"),
+            ]:
+                if row.get(column):
+                    hardware[key] = row[column]
+        platforms = [
+            {
+                "type": t.PROVIDER_NAME,
+                "hostname": row[f"{t.PROVIDER_NAME}_hostname"],
+                "credential": row.get(f"{t.PROVIDER_NAME}_credential"),
+            }
+            for t in PLATFORM_TYPES
+            if row.get(f"{t.PROVIDER_NAME}_hostname")
+        ]
+        custom_ops = (row.get("custom_operations") or "").split(";")
+        return {
+            "name": row.get("name"),
+            "place": row.get("place") or "",
+            "hardware_features": hardware,
+            "software_platforms": platforms,
+            "custom_operations": [name.strip() for name in custom_ops if name.strip()],
+        }
+
+    @staticmethod
+    def refers_to(record):
+        hardware = record.get("hardware_features")
+        if isinstance(hardware, dict) and isinstance(hardware.get("host"), str):
+            return {hardware["host"]}
+        return set()
+
+    @staticmethod
+    def to_row(record):
+        hardware = record["hardware_features"] or {}
+        row = {
+            "name": record["name"],
+            "place": record["place"],
+            "hardware_type": hardware.get("type"),
+            "mac_address": hardware.get("mac_address"),
+            "libvirt_host": hardware.get("host"),
+            "vm_uuid": hardware.get("vm_uuid"),
+            "custom_operations": ";".join(record["custom_operations"]),
+        }
+        # Only the first platform of each type fits in a row.
+        for platform in reversed(record["software_platforms"]):
+            row[f"{platform['type']}_hostname"] = platform["hostname"]
+            row[f"{platform['type']}_credential"] = platform["credential"]
+        return row
+
+    @staticmethod
+    def load(record, refs):
+        errors = {}
+        data = {
+            "name": record.get("name"),
+            "place": record.get("place") or "",
+            "hardware_features": record.get("hardware_features"),
+            "software_platforms": [],
+            "custom_operations": [
+                lookup(
+                    refs.custom_operations,
+                    name,
+                    "custom_operations",
+                    "custom operation",
+                    errors,
+                )
+                for name in record.get("custom_operations") or []
+            ],
+        }
+        if isinstance(data["hardware_features"], dict) and (
+            "host" in data["hardware_features"]
+        ):
+            hardware = dict(data["hardware_features"])
+            hardware["host_id"] = lookup(
+                refs.hosts,
+                hardware.pop("host"),
+                "hardware_features",
+                "host machine",
+                errors,
+            )
+            data["hardware_features"] = hardware
+        for platform in record.get("software_platforms") or []:
+            if not isinstance(platform, dict):
+                raise ValidationError({"software_platforms": ["Must be objects"]})
+            platform = dict(platform)
+            platform["credential_id"] = lookup(
+                refs.credentials,
+                platform.pop("credential", None),
+                "software_platforms",
+                "credential",
+                errors,
+            )
+            data["software_platforms"].append(platform)
+        if errors:
+            raise ValidationError(errors)
+        return refs.machine_schema.load(data, unknown=EXCLUDE)
+
+    @staticmethod
+    def dump(machine, refs):
+        hardware = None
+        if machine.hardware_features:
+            hardware = hardware_features_schema.dump(machine.hardware_features)
+            hardware.pop("id", None)
+            if "host_id" in hardware:
+                hardware["host"] = refs.host_names.get(hardware.pop("host_id"))
+        platforms = []
+        for platform in software_platform_schema.dump(
+            machine.software_platforms, many=True
+        ):
+            platform.pop("id", None)
+            platform["credential"] = refs.credential_names.get(
+                platform.pop("credential_id")
+            )
+            platforms.append(platform)
+        return {
+            "name": machine.name,
+            "place": machine.place,
+            "hardware_features": hardware,
+            "software_platforms": platforms,
+            "custom_operations": [op.name for op in machine.custom_operations],
+        }
+
+    @staticmethod
+    def committed(machines, refs):
+        for machine in machines:
+            for platform in machine.software_platforms:
+                if isinstance(platform, LinuxPlatform):
+                    refs.hosts.setdefault(machine.name, platform.id)
+
+
+class CredentialTransfer:
+    model = Credential
+    # Secrets and keys are never exported, only imported.
+    COLUMNS = ["type", "name", "username", "secret", "key_type", "key"]
+
+    @staticmethod
+    def query():
+        return Credential.query
+
+    @staticmethod
+    def from_row(row):
+        return {name: value for name, value in row.items() if value}
+
+    @staticmethod
+    def refers_to(record):
+        return set()
+
+    @staticmethod
+    def to_row(record):
+        return record
+
+    @staticmethod
+    def load(record, refs):
+        return credential_schema.load(record, unknown=EXCLUDE)
+
+    @staticmethod
+    def dump(credential, refs):
+        record = {
+            "type": credential.PROVIDER_NAME,
+            "name": credential.name,
+            "username": credential.username,
+        }
+        if getattr(credential, "key_type", None):
+            record["key_type"] = credential.key_type
+        return record
+
+    @staticmethod
+    def committed(credentials, refs):
+        refs.credentials |= {c.name: c.id for c in credentials}
+
+
+class CustomOperationTransfer:
+    model = CustomOperation
+    COLUMNS = ["name", "description", "ops"]
+
+    @staticmethod
+    def query():
+        return CustomOperation.query
+
+    @staticmethod
+    def from_row(row):
+        try:
+            ops = json.loads(row.get("ops") or "[]")
+        except ValueError:
+            raise ValidationError({"ops": ["Must be a JSON list of steps"]})
+        return {
+            "name": row.get("name"),
+            "description": row.get("description"),
+            "ops": ops,
+        }
+
+    @staticmethod
+    def refers_to(record):
+        return set()
+
+    @staticmethod
+    def to_row(record):
+        return record | {"ops": json.dumps(record["ops"])}
+
+    @staticmethod
+    def load(record, refs):
+        return custom_op_schema.load(record, unknown=EXCLUDE)
+
+    @staticmethod
+    def dump(custom_operation, refs):
+        return {
+            "name": custom_operation.name,
+            "description": custom_operation.description,
+            "ops": custom_operation.ops,
+        }
+
+    @staticmethod
+    def committed(custom_operations, refs):
+        refs.custom_operations |= {op.name: op.id for op in custom_operations}
+
+
+KINDS = {
+    "machines": MachineTransfer,
+    "credentials": CredentialTransfer,
+    "custom_operations": CustomOperationTransfer,
+}
+
+
+def _discard(obj):
+    if obj in db.session:
+        db.session.expunge(obj)
+
+
+def _commit_batch(kind, batch, refs, report):
+    names = [obj.name for _, obj in batch]
+    with db.session.no_autoflush:
+        taken = {
+            name
+            for (name,) in db.session.query(kind.model.name).filter(
+                kind.model.name.in_(names)
+            )
+        }
+    accepted = []
+    for number, obj in batch:
+        if obj.name in taken:
+            report["errors"].append(
+                {"row": number, "errors": [f"'{obj.name}' already exists"]}
+            )
+            _discard(obj)
+            continue
+        taken.add(obj.name)
+        accepted.append((number, obj))
+
+    db.session.add_all([obj for _, obj in accepted])
+    try:
+        db.session.commit()
+        created = [obj for _, obj in accepted]
+    except IntegrityError:
+        # Something else in the batch is wrong, find the rows one by one.
+        db.session.rollback()
+        created = []
+        for number, obj in accepted:
+            db.session.add(obj)
+            try:
+                db.session.commit()
+                created.append(obj)
+            except IntegrityError as e:
+                db.session.rollback()
+                _discard(obj)
+                report["errors"].append({"row": number, "errors": [str(e.orig)]})
+    kind.committed(created, refs)
+    report["created"] += len(created)
+
+
+def import_records(kind, records, format):
+    # Rows are validated one by one but written in batches of
+    # IMPORT_BATCH_SIZE, one transaction each.
+    report = {"created": 0, "errors": []}
+    refs = References()
+    # The preloaded custom operations would otherwise be expired and read
+    # again after every batch.
+    session = db.session()
+    expire_on_commit, session.expire_on_commit = session.expire_on_commit, False
+    try:
+        _import_batches(kind, _read(records, report), format, refs, report)
+    except Exception:
+        db.session.rollback()
+        raise
+    finally:
+        session.expire_on_commit = expire_on_commit
+
+    form_options_cache.invalidate()
+    operations_cache.invalidate()
+    return report
+
+
+def _read(records, report):
+    # A file that can't be read any further (bad encoding, broken YAML, an
+    # oversized CSV field) ends the import, the rows read before it are
+    # still written and the error is reported with them.
+    number = 0
+    try:
+        for number, record, error in records:
+            yield number, record, error
+    except (ValueError, csv.Error) as e:
+        report["errors"].append({"row": number + 1, "errors": [str(e)]})
+
+
+def _import_batches(kind, records, format, refs, report):
+    batch = []
+    for number, record, error in records:
+        try:
+            if error is not None:
+                raise ValidationError(error)
+            if format == "csv":
+                record = kind.from_row(record)
+            if not isinstance(record, dict):
+                raise ValidationError("Record must be an object")
+            if kind.refers_to(record) & {obj.name for _, obj in batch}:
+                # A machine running on a host from the same batch, the host
+                # has to be written first.
+                _commit_batch(kind, batch, refs, report)
+                batch = []
+            with db.session.no_autoflush:
+                batch.append((number, kind.load(record, refs)))
+        except ValidationError as e:
+            report["errors"].append(
+                {"row": number, "errors": list(error_messages(e.messages))}
+            )
+            continue
+        if len(batch) >= IMPORT_BATCH_SIZE:
+            _commit_batch(kind, batch, refs, report)
+            batch = []
+    if batch:
+        _commit_batch(kind, batch, refs, report)
+
+
+def export_records(kind):
+    refs = References()
+    # Keyset pagination, only one batch of rows is in memory at a time.
+    last_id = 0
+    while True:
+        items = (
+            kind.query()
+            .filter(kind.model.id > last_id)
+            .order_by(kind.model.id)
+            .limit(IMPORT_BATCH_SIZE)
+            .all()
+        )
+        if not items:
+            return
+        for item in items:
+            yield kind.dump(item, refs)
+        last_id = items[-1].id
+        db.session.expunge_all()
+
+
+def export_response(kind_name, format):
+    check_format(format)
+    kind = KINDS[kind_name]
+    records = export_records(kind)
+    if format == "csv":
+        records = map(kind.to_row, records)
+    return Response(
+        stream_with_context(write_records(records, format, kind.COLUMNS)),
+        mimetype=FORMATS[format],
+        headers={"Content-Disposition": f"attachment; filename={kind_name}.{format}"},
+    )
+
+
+def _render_transfer(**kwargs):
+    formats = [f for f in FORMATS if (f != "yaml") or (yaml is not None)]
+    return render_template("transfer.html", kinds=KINDS, formats=formats, **kwargs)
+
+
+@transfer.route("/transfer", methods=["GET"])
+@auth.login_required
+def transfer_page():
+    return _render_transfer(), 200
+
+
+@transfer.route("/import", methods=["POST"])
+@auth.login_required
+def import_file():
+    kind_name = request.form.get("kind")
+    upload = request.files.get("file")
+    if (kind_name not in KINDS) or (upload is None) or (not upload.filename):
+        return _render_transfer(errors=["Choose what to import and a file"]), 200
+    format = request.form.get("format") or format_from_filename(upload.filename)
+    try:
+        check_format(format)
+        report = import_records(
+            KINDS[kind_name], read_records(upload.stream, format), format
+        )
+    except ValueError as e:
+        return _render_transfer(errors=[str(e)]), 200
+    return _render_transfer(kind=kind_name, report=report), 200
+
+
+@transfer.route("/export/<any(machines, credentials, custom_operations):kind>")
+@auth.login_required
+def export_file(kind):
+    try:
+        return export_response(kind, request.args.get("format", "csv"))
+    except ValueError as e:
+        return render_template("error.html", message=str(e), redirect="/transfer")
@@ -0,0 +1,39 @@
+from app import db
+
+
+# Jobs run in the worker which accepted them, their state is written here so
+# every worker can show it.
+class JobRecord(db.Model):
+    __tablename__ = "jobs"
+    __table_args__ = (db.Index("ix_jobs_machine_status", "machine_id", "status"),)
+
+    id = db.Column(db.String(32), primary_key=True)
+    # Children of a fleet job point to it, a fleet job has no machine.
+    parent_id = db.Column(
+        db.String(32), db.ForeignKey("jobs.id", ondelete="CASCADE"), index=True
+    )
+    machine_id = db.Column(db.Integer)
+    name = db.Column(db.String(127), nullable=False)
+    status = db.Column(db.String(16), nullable=False)
+    # Result of a fleet job child as seen by its parent.
+    error = db.Column(db.Text)
+    duration = db.Column(db.Float)
+    created = db.Column(db.DateTime, nullable=False, index=True)
+    started = db.Column(db.DateTime)
+    finished = db.Column(db.DateTime)
+    updated = db.Column(db.DateTime, nullable=False)
+
+
+class JobStepRecord(db.Model):
+    __tablename__ = "job_steps"
+
+    job_id = db.Column(
+        db.String(32), db.ForeignKey("jobs.id", ondelete="CASCADE"), primary_key=True
+    )
+    index = db.Column(db.Integer, primary_key=True)
+    op_name = db.Column(db.String(127), nullable=False)
+    argument = db.Column(db.Text)
+    status = db.Column(db.String(16), nullable=False)
+    output = db.Column(db.Text)
+    error = db.Column(db.Text)
+    duration = db.Column(db.Float)
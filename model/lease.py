@@ -0,0 +1,9 @@
+from app import db
+
+
+class Lease(db.Model):
+    __tablename__ = "leases"
+
+    name = db.Column(db.String(64), primary_key=True)
+    holder = db.Column(db.String(127), nullable=False)
+    expires = db.Column(db.DateTime, nullable=False)
@@ -0,0 +1,62 @@
+from app import db
+
+
+class Schedule(db.Model):
+    __tablename__ = "schedules"
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(127), nullable=False, unique=True)
+    cron = db.Column(db.String(127), nullable=False)
+    custom_operation_id = db.Column(
+        db.Integer,
+        db.ForeignKey("custom_operations.id", ondelete="CASCADE"),
+        nullable=False,
+    )
+    # Without a machine the operation runs on every machine it is assigned to.
+    machine_id = db.Column(
+        db.Integer, db.ForeignKey("machines.id", ondelete="CASCADE"), nullable=True
+    )
+    jitter = db.Column(db.Integer, nullable=False, default=0)
+    enabled = db.Column(db.Boolean, nullable=False, default=True)
+    next_run = db.Column(db.DateTime, index=True)
+    last_run = db.Column(db.DateTime)
+
+    custom_operation = db.relationship(
+        "CustomOperation",
+        backref=db.backref("schedules", cascade="all, delete-orphan"),
+    )
+    machine = db.relationship(
+        "Machine", backref=db.backref("schedules", cascade="all, delete-orphan")
+    )
+    runs = db.relationship(
+        "ScheduleRun",
+        back_populates="schedule",
+        cascade="all, delete-orphan",
+        order_by="ScheduleRun.started.desc()",
+        lazy="dynamic",
+    )
+
+
+class ScheduleRun(db.Model):
+    __tablename__ = "schedule_runs"
+    __table_args__ = (
+        db.Index("ix_schedule_runs_schedule_started", "schedule_id", "started"),
+        db.Index("ix_schedule_runs_status_due", "status", "due_at"),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    schedule_id = db.Column(
+        db.Integer, db.ForeignKey("schedules.id", ondelete="CASCADE"), nullable=False
+    )
+    machine_id = db.Column(db.Integer, nullable=False)
+    machine_name = db.Column(db.String(127), nullable=False)
+    job_id = db.Column(db.String(32))
+    status = db.Column(db.String(16), nullable=False)
+    error = db.Column(db.Text)
+    # Runs are written as pending when the schedule fires, due_at includes
+    # the machine's jitter so a restart doesn't lose or repeat them.
+    due_at = db.Column(db.DateTime, nullable=False)
+    started = db.Column(db.DateTime, nullable=False, index=True)
+    finished = db.Column(db.DateTime)
+
+    schedule = db.relationship("Schedule", back_populates="runs")
@@ -0,0 +1,9 @@
+from app import db
+
+
+class SessionDraft(db.Model):
+    __tablename__ = "session_drafts"
+
+    id = db.Column(db.String(32), primary_key=True)
+    data = db.Column(db.JSON, nullable=False)
+    expires = db.Column(db.DateTime, nullable=False, index=True)
@@ -0,0 +1,34 @@
+from app import db
+from model.base import MachineStatus
+
+
+class StatusEvent(db.Model):
+    __tablename__ = "status_events"
+    __table_args__ = (db.Index("ix_status_events_machine_time", "machine_id", "time"),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    machine_id = db.Column(
+        db.Integer, db.ForeignKey("machines.id", ondelete="CASCADE"), nullable=False
+    )
+    time = db.Column(db.DateTime, nullable=False, index=True)
+    status = db.Column(db.Enum(MachineStatus), nullable=False)
+
+
+class StatusSummary(db.Model):
+    __tablename__ = "status_summaries"
+    __table_args__ = (db.Index("ix_status_summaries_period_start", "period", "start"),)
+
+    HOUR = "hour"
+    DAY = "day"
+
+    machine_id = db.Column(
+        db.Integer,
+        db.ForeignKey("machines.id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    period = db.Column(db.String(8), primary_key=True)
+    start = db.Column(db.DateTime, primary_key=True)
+    samples = db.Column(db.Integer, nullable=False, default=0)
+    power_on = db.Column(db.Integer, nullable=False, default=0)
+    power_off = db.Column(db.Integer, nullable=False, default=0)
+    suspended = db.Column(db.Integer, nullable=False, default=0)
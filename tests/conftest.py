@@ -0,0 +1,73 @@
+import base64
+import os
+import tempfile
+
+import pytest
+
+# app.py reads its configuration and opens the database on import.
+DB_DIR = tempfile.mkdtemp()
+os.environ["DOM_DB_URL"] = f"sqlite:///{os.path.join(DB_DIR, 'dom.db')}"
+os.environ["DOM_SECRET_KEY"] = "test"
+os.environ["DOM_PASSWORD"] = "test"
+os.environ["DOM_POLL_INTERVAL"] = "0"
+os.environ["DOM_SCHEDULER_INTERVAL"] = "0"
+
+from app import app, db, USERNAME  # noqa: E402
+from controller.machine import form_options_cache, operations_cache  # noqa: E402
+from model.credential import Credential  # noqa: E402
+from model.custom_operation import CustomOperation  # noqa: E402
+from model.machine import Machine  # noqa: E402
+
+
+@pytest.fixture
+def auth_headers():
+    token = base64.b64encode(f"{USERNAME}:test".encode()).decode()
+    return {"Authorization": f"Basic {token}"}
+
+
+@pytest.fixture
+def client():
+    yield app.test_client()
+    with app.app_context():
+        for model in (Machine, CustomOperation, Credential):
+            for obj in model.query.all():
+                db.session.delete(obj)
+        db.session.commit()
+    form_options_cache.invalidate()
+    operations_cache.invalidate()
+
+
+@pytest.fixture
+def credential(client, auth_headers):
+    response = client.post(
+        "/api/v1/credentials",
+        headers=auth_headers,
+        json={"type": "password", "name": "root", "username": "root", "secret": "pw"},
+    )
+    assert response.status_code == 201, response.json
+    return response.json
+
+
+@pytest.fixture
+def create_machine(client, auth_headers, credential):
+    # A machine with a Linux platform, other fields are added to the payload.
+    def create(name, **fields):
+        response = client.post(
+            "/api/v1/machines",
+            headers=auth_headers,
+            json={
+                "name": name,
+                "software_platforms": [
+                    {
+                        "type": "linux",
+                        "hostname": f"{name}.example",
+                        "credential_id": credential["id"],
+                    }
+                ],
+                **fields,
+            },
+        )
+        assert response.status_code == 201, response.json
+        return response.json["id"]
+
+    return create
@@ -0,0 +1,21 @@
+from datetime import datetime
+
+from app import app
+from model.base import MachineStatus
+from model.status_event import StatusEvent, StatusSummary
+from utils.fleet import save_statuses
+from utils.history import compact
+
+
+def test_deleted_machine_leaves_no_history(create_machine, client, auth_headers):
+    machine_id = create_machine("server")
+    with app.app_context():
+        save_statuses({machine_id: MachineStatus.POWER_ON}, datetime(2020, 1, 1))
+        compact(datetime(2020, 3, 1))
+        assert StatusSummary.query.filter_by(machine_id=machine_id).count()
+
+    response = client.delete(f"/api/v1/machines/{machine_id}", headers=auth_headers)
+    assert response.status_code == 204
+    with app.app_context():
+        assert not StatusEvent.query.filter_by(machine_id=machine_id).count()
+        assert not StatusSummary.query.filter_by(machine_id=machine_id).count()
@@ -0,0 +1,75 @@
+from contextlib import contextmanager
+
+import pytest
+from sqlalchemy import event
+
+from app import app, db
+from controller.machine import form_options_cache, operations_cache
+
+
+@contextmanager
+def recorded_statements():
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, "before_cursor_execute", record)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, "before_cursor_execute", record)
+
+
+def count_statements(url, headers):
+    # A fresh client without a session and cold caches, so every
+    # measurement does the same work apart from the number of machines.
+    app.test_client().get(url, headers=headers)
+    form_options_cache.invalidate()
+    operations_cache.invalidate()
+    with app.app_context(), recorded_statements() as statements:
+        response = app.test_client().get(url, headers=headers)
+    assert response.status_code == 200
+    return len(statements)
+
+
+@pytest.fixture
+def add_machines(client, auth_headers, create_machine):
+    operation = client.post(
+        "/api/v1/custom_operations",
+        headers=auth_headers,
+        json={"name": "uptime", "description": "", "ops": []},
+    ).json
+    ids = []
+
+    def add(count):
+        for _ in range(count):
+            number = len(ids)
+            ids.append(
+                create_machine(
+                    f"machine{number}",
+                    place="lab",
+                    hardware_features={
+                        "type": "wakeonlan",
+                        "mac_address": f"02:00:00:00:00:{number:02x}",
+                    },
+                    custom_operations=[operation["id"]],
+                )
+            )
+        return ids
+
+    return add
+
+
+def test_machine_list_query_count(add_machines, auth_headers):
+    add_machines(1)
+    one = count_statements("/", auth_headers)
+    add_machines(9)
+    assert count_statements("/", auth_headers) == one
+
+
+def test_edit_machine_query_count(add_machines, auth_headers):
+    first = add_machines(1)[0]
+    one = count_statements(f"/edit_machine/{first}", auth_headers)
+    add_machines(9)
+    assert count_statements(f"/edit_machine/{first}", auth_headers) == one
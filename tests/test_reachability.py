@@ -0,0 +1,123 @@
+from time import monotonic
+
+import pytest
+
+from app import app, BULK_WORKERS, BULK_TIMEOUT
+from model.base import MachineStatus
+from model.machine import Machine
+from utils.fleet import ensure_statuses, get_statuses
+from utils.reachability import reachability, HostUnreachable
+
+
+@pytest.fixture
+def host_down(monkeypatch):
+    monkeypatch.setattr(reachability, "probe", lambda address: False)
+
+
+@pytest.fixture
+def machine_id(create_machine):
+    # Reached only through its operating system, so a host which doesn't
+    # answer is switched off.
+    return create_machine("server")
+
+
+def last_status(machine_id):
+    with app.app_context():
+        return Machine.query.get(machine_id).last_status
+
+
+def test_unreachable_host_is_off(host_down, machine_id):
+    with app.app_context():
+        machine = Machine.query.get(machine_id)
+        assert reachability.check_machine(machine) == MachineStatus.POWER_OFF
+        [result] = get_statuses([machine_id], BULK_WORKERS, BULK_TIMEOUT)
+    assert result.error is None
+    assert result.value == MachineStatus.POWER_OFF
+
+
+def test_unreachable_host_cannot_be_powered_on(host_down, machine_id):
+    with app.app_context():
+        machine = Machine.query.get(machine_id)
+        with pytest.raises(HostUnreachable):
+            reachability.check_machine(machine, MachineStatus.POWER_ON)
+
+
+def test_power_off_single(host_down, machine_id, client, auth_headers):
+    response = client.get(
+        f"/change_status/{machine_id}?target_status=POWER_OFF", headers=auth_headers
+    )
+    assert response.status_code == 200
+    assert b"Successfully set machine" in response.data
+    assert last_status(machine_id) == MachineStatus.POWER_OFF
+
+
+def test_power_off_bulk(host_down, machine_id, client, auth_headers):
+    with app.app_context():
+        [result] = ensure_statuses(
+            [machine_id], MachineStatus.POWER_OFF, BULK_WORKERS, BULK_TIMEOUT
+        )
+    assert result.error is None
+    assert result.value == MachineStatus.POWER_OFF
+
+    response = client.post(
+        "/change_status",
+        headers=auth_headers,
+        data={"target_status": "POWER_OFF", "machine_id": str(machine_id)},
+    )
+    assert response.status_code == 200
+    assert last_status(machine_id) == MachineStatus.POWER_OFF
+
+
+def test_power_off_api(host_down, machine_id, client, auth_headers):
+    response = client.post(
+        f"/api/v1/machines/{machine_id}/status",
+        headers=auth_headers,
+        json={"target_status": "POWER_OFF"},
+    )
+    assert response.status_code == 200
+    assert response.json == {"status": MachineStatus.POWER_OFF.value, "success": True}
+
+
+def test_power_on_api_unreachable(host_down, machine_id, client, auth_headers):
+    response = client.post(
+        f"/api/v1/machines/{machine_id}/status",
+        headers=auth_headers,
+        json={"target_status": "POWER_ON"},
+    )
+    assert response.status_code == 503
+
+
+def test_power_on_forgets_down_hosts(create_machine, client, auth_headers):
+    machine_id = create_machine(
+        "desktop",
+        hardware_features={"type": "wakeonlan", "mac_address": "02:00:00:00:00:01"},
+    )
+    address = ("desktop.example", reachability.ports["linux"])
+    reachability._down[address] = monotonic() + 60
+
+    response = client.post(
+        f"/api/v1/machines/{machine_id}/status",
+        headers=auth_headers,
+        json={"target_status": "POWER_ON"},
+    )
+    assert response.json["success"]
+    assert not reachability._is_down(address)
+
+
+def test_operation_provider_is_the_one_that_runs(
+    create_machine, credential, monkeypatch
+):
+    # execute_operations runs an operation with its first provider, a
+    # reachable second one doesn't help.
+    platforms = [
+        {"type": "linux", "hostname": hostname, "credential_id": credential["id"]}
+        for hostname in ["first.example", "second.example"]
+    ]
+    machine_id = create_machine("server", software_platforms=platforms)
+    monkeypatch.setattr(
+        reachability, "probe", lambda address: address[0] != "first.example"
+    )
+    with app.app_context():
+        machine = Machine.query.get(machine_id)
+        with pytest.raises(HostUnreachable):
+            reachability.operation_provider(machine, "run_command")
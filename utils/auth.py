@@ -0,0 +1,76 @@
+import hmac
+from hashlib import sha256
+from logging import warning
+from secrets import token_bytes
+
+import bcrypt
+from sqlalchemy.exc import IntegrityError
+
+from app import db, AUTH_CACHE_TTL, AUTH_CACHE_SIZE
+from model.user import User
+from utils.cache import MemoryCache
+
+# Every request carries Basic auth, a recently verified username/password
+# pair is remembered so bcrypt only runs once per TTL. Entries are keyed by
+# an HMAC with a per-process key, plaintext passwords are never stored.
+_digest_key = token_bytes(32)
+verified_cache = MemoryCache(maxsize=AUTH_CACHE_SIZE, ttl=AUTH_CACHE_TTL)
+
+
+class _Rejected(Exception):
+    pass
+
+
+def hash_password(password):
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
+
+
+def check_password(password, password_hash):
+    return bcrypt.checkpw(password.encode(), password_hash.encode())
+
+
+def _digest(username, password):
+    message = f"{username}\0{password}".encode()
+    return hmac.new(_digest_key, message, sha256).digest()
+
+
+def _verify(username, password):
+    user = User.query.filter_by(username=username).first()
+    if (user is not None) and check_password(password, user.password_hash):
+        return user.username
+    # Raised rather than returned, so a failed attempt is never cached and
+    # a user created or fixed in another worker can log in at once.
+    raise _Rejected()
+
+
+def verify_user(username, password):
+    try:
+        return verified_cache.get(
+            _digest(username, password), lambda: _verify(username, password)
+        )
+    except _Rejected:
+        return None
+
+
+def ensure_admin(username, password):
+    # Every worker runs this when it starts. Only a configured password is
+    # used here, a generated one would differ between the workers.
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        if not password:
+            warning(
+                "There is no '%s' user, set DOM_PASSWORD or run 'flask create-admin'",
+                username,
+            )
+            return
+        db.session.add(User(username=username, password_hash=hash_password(password)))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Another worker created it first, with the same password.
+            db.session.rollback()
+            return
+    elif password and not check_password(password, user.password_hash):
+        user.password_hash = hash_password(password)
+        db.session.commit()
+    verified_cache.invalidate()
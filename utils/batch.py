@@ -0,0 +1,101 @@
+from collections import deque
+from shlex import quote
+from time import monotonic
+from uuid import uuid4
+
+from model.software_platform import LinuxPlatform
+from utils.reachability import reachability
+from utils.ssh import ssh_pool
+
+# Operations whose argument is a shell command line, consecutive steps of
+# these can be sent to the host as a single script.
+SHELL_OPS = {"run_command"}
+
+
+class StepResult:
+    def __init__(self, output, exit_code, duration):
+        self.output = output
+        self.exit_code = exit_code
+        self.duration = duration
+
+
+def find_batch_platform(machine):
+    for platform in machine.software_platforms:
+        if isinstance(platform, LinuxPlatform) and reachability.is_reachable(platform):
+            return platform
+    return None
+
+
+def split_batches(steps):
+    batch = []
+    for step in steps:
+        if step.op_name in SHELL_OPS:
+            batch.append(step)
+            continue
+        if batch:
+            yield batch
+            batch = []
+        yield [step]
+    if batch:
+        yield batch
+
+
+def compile_script(commands, marker):
+    lines = ["exec 2>&1"]
+    for i, command in enumerate(commands):
+        lines += [
+            f"printf '%s\\n' '{marker} begin {i}'",
+            f"sh -c {quote(command)}",
+            "status=$?",
+            f"printf '\\n%s %d\\n' '{marker} end {i}' $status",
+            '[ "$status" -eq 0 ] || exit "$status"',
+        ]
+    return "\n".join(lines) + "\n"
+
+
+def parse_output(lines, marker, count, on_line=None, max_lines=None):
+    results = [None] * count
+    current, output, started = None, deque(maxlen=max_lines), monotonic()
+    pending = None
+
+    def emit(line):
+        output.append(line.removesuffix("\n"))
+        if on_line is not None:
+            on_line(current, line.removesuffix("\n"))
+
+    for line in lines:
+        if line.startswith(f"{marker} begin "):
+            current, started = int(line.split()[-1]), monotonic()
+            output, pending = deque(maxlen=max_lines), None
+        elif line.startswith(f"{marker} end "):
+            _, _, index, exit_code = line.split()
+            # The end marker is printed on a new line, drop the separator.
+            if pending not in (None, "\n"):
+                emit(pending)
+            results[int(index)] = StepResult(
+                "\n".join(output), int(exit_code), monotonic() - started
+            )
+            current = None
+        elif current is not None:
+            # Lines are passed on one behind, so the separator before the
+            # end marker can still be dropped.
+            if pending is not None:
+                emit(pending)
+            pending = line
+    return results
+
+
+def run_batch(platform, commands, on_line=None, max_lines=None):
+    marker = f"#dom-{uuid4().hex}"
+    script = compile_script(commands, marker)
+    with ssh_pool.connection(platform.hostname, platform.credential) as client:
+        # The script is passed as an argument, not on stdin, and stdin is
+        # closed at once: a step reading its input gets EOF instead of the
+        # rest of the script.
+        stdin, stdout, _ = client.exec_command(f"sh -c {quote(script)}")
+        stdin.channel.shutdown_write()
+        results = parse_output(
+            iter(stdout.readline, ""), marker, len(commands), on_line, max_lines
+        )
+        # -1 when the connection dropped before sh reported its status.
+        return results, stdout.channel.recv_exit_status()
@@ -0,0 +1,44 @@
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+
+class MemoryCache:
+    def __init__(self, maxsize=None, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._generation = 0
+        self._lock = Lock()
+
+    def get(self, key, factory):
+        with self._lock:
+            if key in self._entries:
+                value, expires = self._entries[key]
+                if (expires is None) or (expires > monotonic()):
+                    self._entries.move_to_end(key)
+                    return value
+                del self._entries[key]
+            generation = self._generation
+
+        value = factory()
+        with self._lock:
+            # Don't store values computed before an invalidation, they may
+            # already be out of date.
+            if generation == self._generation:
+                expires = monotonic() + self.ttl if self.ttl else None
+                self._entries[key] = (value, expires)
+                if self.maxsize and len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+        return value
+
+    def invalidate(self, key=None):
+        with self._lock:
+            self._generation += 1
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,79 @@
+from datetime import datetime, timedelta
+
+ALIASES = {
+    "@hourly": "0 * * * *",
+    "@daily": "0 0 * * *",
+    "@nightly": "0 0 * * *",
+    "@weekly": "0 0 * * 0",
+    "@monthly": "0 0 1 * *",
+}
+# (first, last) allowed value of every field, day of week 7 is Sunday too.
+FIELDS = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+MAX_YEARS = 5
+
+
+def _parse_field(text, first, last):
+    values = set()
+    for part in text.split(","):
+        range_text, _, step_text = part.partition("/")
+        try:
+            step = int(step_text) if step_text else 1
+            if range_text == "*":
+                start, end = first, last
+            elif "-" in range_text:
+                start, end = (int(v) for v in range_text.split("-", 1))
+            else:
+                start = int(range_text)
+                end = last if step_text else start
+        except ValueError:
+            raise ValueError(f"Incorrect value '{part}'")
+        if not (first <= start <= end <= last) or step < 1:
+            raise ValueError(f"Value out of range in '{part}'")
+        values.update(range(start, end + 1, step))
+    return values
+
+
+class CronSchedule:
+    def __init__(self, expression):
+        self.expression = expression
+        fields = ALIASES.get(expression.strip(), expression).split()
+        if len(fields) != len(FIELDS):
+            raise ValueError("Cron expression must have 5 fields")
+        try:
+            parsed = [
+                _parse_field(text, first, last)
+                for text, (first, last) in zip(fields, FIELDS)
+            ]
+        except ValueError as e:
+            raise ValueError(f"Incorrect cron expression: {e}")
+        self.minutes, self.hours, self.days, self.months, weekdays = parsed
+        self.weekdays = {day % 7 for day in weekdays}
+        # Like cron, when both days of month and of week are restricted a
+        # day matching either of them is enough.
+        # Compared after expansion, so "*/1" or "1-31" count as unrestricted
+        # just like "*".
+        self.any_day = self.days == set(range(FIELDS[2][0], FIELDS[2][1] + 1))
+        self.any_weekday = self.weekdays == set(range(7))
+
+    def _day_matches(self, time):
+        weekday = (time.weekday() + 1) % 7
+        if self.any_day or self.any_weekday:
+            return (time.day in self.days) and (weekday in self.weekdays)
+        return (time.day in self.days) or (weekday in self.weekdays)
+
+    def next_after(self, time):
+        time = time.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = time + timedelta(days=366 * MAX_YEARS)
+        while time < limit:
+            if time.month not in self.months:
+                year, month = divmod(time.month, 12)
+                time = datetime(time.year + year, month + 1, 1)
+            elif not self._day_matches(time):
+                time = time.replace(hour=0, minute=0) + timedelta(days=1)
+            elif time.hour not in self.hours:
+                time = time.replace(minute=0) + timedelta(hours=1)
+            elif time.minute not in self.minutes:
+                time += timedelta(minutes=1)
+            else:
+                return time
+        raise ValueError(f"'{self.expression}' never matches")
@@ -0,0 +1,30 @@
+from sqlite3 import Connection as SQLiteConnection
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+def engine_options(url, pool_size, max_overflow, pool_recycle, busy_timeout):
+    if url.startswith("sqlite"):
+        return {"connect_args": {"timeout": busy_timeout}}
+    return {
+        "pool_size": pool_size,
+        "max_overflow": max_overflow,
+        "pool_recycle": pool_recycle,
+        "pool_pre_ping": True,
+    }
+
+
+def configure_sqlite(busy_timeout):
+    # WAL lets the web workers read while the poller or a job writes, the
+    # busy timeout makes writers wait for each other instead of failing
+    # with "database is locked".
+    @event.listens_for(Engine, "connect")
+    def set_pragmas(connection, record):
+        if not isinstance(connection, SQLiteConnection):
+            return
+        cursor = connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA busy_timeout={int(busy_timeout * 1000)}")
+        cursor.close()
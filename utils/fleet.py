@@ -0,0 +1,284 @@
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime
+from functools import partial
+from time import monotonic
+
+from sqlalchemy.orm import selectinload
+
+from app import app, db
+from model.base import MachineStatus
+from model.hardware_features import WakeOnLan, LibvirtGuest
+from model.machine import Machine
+from model.software_platform import LinuxPlatform
+from model.status_event import StatusEvent
+from utils.hypervisor import (
+    HypervisorUnavailable,
+    group_guests,
+    guest_statuses,
+    change_guest_statuses,
+    run_on_hosts,
+)
+from utils.metrics import timed_operation
+from utils.reachability import reachability, HostUnreachable
+from utils.wakeonlan import send_magic_packets, wait_until_up
+
+STATUS_BATCH_SIZE = 100
+WAIT_TICK = 0.5
+
+MachineResult = namedtuple(
+    "MachineResult", ["machine_id", "value", "error", "duration"]
+)
+
+
+def _run_for_machine(func, machine_id, started, busy):
+    # Every worker gets its own app context, so it also gets its own
+    # scoped database session instead of sharing the caller's one.
+    try:
+        with app.app_context():
+            started[machine_id] = monotonic()
+            try:
+                machine = Machine.query.get(machine_id)
+                value, error = func(machine), None
+            except Exception as e:
+                value, error = None, e
+            return MachineResult(
+                machine_id, value, error, monotonic() - started[machine_id]
+            )
+    finally:
+        busy.discard(machine_id)
+
+
+def run_on_machines(machine_ids, func, workers, timeout, on_result=None, busy=None):
+    # Machines in `busy` are still running a call from an earlier run which
+    # timed out. They are skipped, so calls that hang don't pile up a new
+    # thread on every run.
+    machine_ids = list(machine_ids)
+    busy = set() if busy is None else busy
+    started = {}
+    results = {}
+    for id in machine_ids:
+        if id in busy:
+            error = TimeoutError("Still waiting for the previous answer")
+            results[id] = MachineResult(id, None, error, 0)
+            if on_result:
+                on_result(results[id])
+    todo = [id for id in machine_ids if id not in results]
+    if not todo:
+        return [results[id] for id in machine_ids]
+
+    busy.update(todo)
+    executor = ThreadPoolExecutor(max_workers=min(workers, len(todo)))
+    futures = {
+        executor.submit(_run_for_machine, func, id, started, busy): id for id in todo
+    }
+    pending = set(futures)
+    while pending:
+        done, pending = wait(pending, timeout=WAIT_TICK, return_when=FIRST_COMPLETED)
+        for future in done:
+            results[futures[future]] = future.result()
+            if on_result:
+                on_result(results[futures[future]])
+
+        now = monotonic()
+        for future in list(pending):
+            id = futures[future]
+            if (id in started) and (now - started[id] > timeout):
+                pending.discard(future)
+                error = TimeoutError(f"No answer after {timeout} seconds")
+                results[id] = MachineResult(id, None, error, now - started[id])
+                if on_result:
+                    on_result(results[id])
+
+    # Hosts which timed out keep their worker busy until the provider gives
+    # up, don't make the caller wait for them.
+    executor.shutdown(wait=False)
+    return [results[id] for id in machine_ids]
+
+
+def _machine_op(op, func):
+    def run(machine):
+        features = machine.hardware_features
+        provider = features.PROVIDER_NAME if features else "platform"
+        with timed_operation(provider, op):
+            return func(machine)
+
+    return run
+
+
+def _host_op(op, func):
+    def run(host, guests):
+        with timed_operation(LibvirtGuest.PROVIDER_NAME, op):
+            return func(host, guests)
+
+    return run
+
+
+def _load_machines(machine_ids):
+    return Machine.query.options(
+        selectinload(Machine.hardware_features),
+        selectinload(Machine.software_platforms),
+    ).filter(Machine.id.in_(machine_ids))
+
+
+def _skip_unreachable(machines, groups, others, target_status=None):
+    # All hosts are probed concurrently up front, so the dead ones are
+    # settled at once instead of each holding a worker until its connect
+    # timeout.
+    machines = {m.id: m for m in machines if m.id in others}
+    hosts = LinuxPlatform.query.filter(LinuxPlatform.id.in_(groups)).all()
+    down = reachability.unreachable(
+        [p for m in machines.values() for p in m.software_platforms] + hosts
+    )
+    settled = {}
+    for id, machine in machines.items():
+        try:
+            status = reachability.check_machine(machine, target_status, down)
+            if status is not None:
+                settled[id] = MachineResult(id, status, None, 0)
+        except HostUnreachable as e:
+            settled[id] = MachineResult(id, None, e, 0)
+    for host in hosts:
+        if reachability.is_probed(host) and (reachability.address(host) in down):
+            error = HostUnreachable(f"Hypervisor {host.hostname} is not reachable")
+            settled |= {
+                id: MachineResult(id, None, error, 0) for id in groups.pop(host.id)
+            }
+    return settled
+
+
+def _run_guests(groups, func, host_func, workers, timeout, busy):
+    results, fallback = {}, []
+    for id, (value, error, duration) in run_on_hosts(
+        groups, host_func, workers, timeout
+    ).items():
+        if isinstance(error, HypervisorUnavailable):
+            # Without a connection to the host every guest is asked through
+            # its own provider instead.
+            fallback.append(id)
+            continue
+        if (value is None) and (error is None):
+            error = LookupError("Virtual machine not found on its host")
+        results[id] = MachineResult(id, value, error, duration)
+    results |= {
+        r.machine_id: r
+        for r in run_on_machines(fallback, func, workers, timeout, busy=busy)
+    }
+    return results
+
+
+def _run_grouped_by_host(
+    machine_ids,
+    func,
+    host_func,
+    workers,
+    timeout,
+    machines=None,
+    target_status=None,
+    busy=None,
+):
+    if machines is None:
+        machines = _load_machines(machine_ids).all()
+    groups, others = group_guests(machines)
+    results = _skip_unreachable(machines, groups, others, target_status)
+    others = [id for id in others if id not in results]
+    # Nothing is written before the results come back, don't keep the read
+    # transaction open while waiting on the machines.
+    db.session.commit()
+
+    # Guests and the other machines are waited on at the same time instead
+    # of one group after the other.
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        guests = executor.submit(
+            _run_guests, groups, func, host_func, workers, timeout, busy
+        )
+        results |= {
+            r.machine_id: r
+            for r in run_on_machines(others, func, workers, timeout, busy=busy)
+        }
+        results |= guests.result()
+    return [results[id] for id in machine_ids if id in results]
+
+
+def get_statuses(machine_ids, workers, timeout, busy=None):
+    # Libvirt guests are asked for through their host, with one domain
+    # listing per hypervisor instead of one connection per guest.
+    return _run_grouped_by_host(
+        machine_ids,
+        _machine_op("get_status", lambda m: m.get_status()),
+        _host_op("get_status", guest_statuses),
+        workers,
+        timeout,
+        busy=busy,
+    )
+
+
+def wait_until_woken(machine_ids, workers, timeout):
+    # Every machine is watched concurrently until it is up or the deadline
+    # passes.
+    deadline = monotonic() + timeout
+    return run_on_machines(
+        machine_ids,
+        _machine_op("wake", partial(wait_until_up, deadline=deadline)),
+        workers,
+        timeout + WAIT_TICK,
+    )
+
+
+def ensure_statuses(machine_ids, target_status, workers, timeout):
+    machines = _load_machines(machine_ids).all()
+    hostnames = {m.id: [p.hostname for p in m.software_platforms] for m in machines}
+    waking = {}
+    if target_status == MachineStatus.POWER_ON:
+        waking = {
+            m.id: m.hardware_features.mac_address
+            for m in machines
+            if isinstance(m.hardware_features, WakeOnLan)
+        }
+
+    # Magic packets go out first, so the machines boot while the others are
+    # being switched, and both groups are waited on at the same time.
+    if waking:
+        send_magic_packets(waking.values())
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        woken = executor.submit(wait_until_woken, list(waking), workers, timeout)
+        results = _run_grouped_by_host(
+            [id for id in machine_ids if id not in waking],
+            _machine_op("ensure_status", lambda m: m.ensure_status(target_status)),
+            _host_op(
+                "ensure_status",
+                partial(
+                    change_guest_statuses, target_status=target_status, timeout=timeout
+                ),
+            ),
+            workers,
+            timeout,
+            [m for m in machines if m.id not in waking],
+            target_status,
+        )
+        results = {r.machine_id: r for r in results + woken.result()}
+    # Machines which came up are probed anew instead of staying down until
+    # their entries expire.
+    for result in results.values():
+        if result.value == MachineStatus.POWER_ON:
+            for hostname in hostnames.get(result.machine_id, []):
+                reachability.forget(hostname)
+    return [results[id] for id in machine_ids if id in results]
+
+
+def save_statuses(statuses, time=None):
+    time = time or datetime.now()
+    mappings = [
+        {"id": id, "last_status": status, "last_status_time": time}
+        for id, status in statuses.items()
+    ]
+    events = [
+        {"machine_id": id, "time": time, "status": status}
+        for id, status in statuses.items()
+    ]
+    # Status history is append-only, events go in the same short
+    # transaction as the machines they describe.
+    for i in range(0, len(mappings), STATUS_BATCH_SIZE):
+        db.session.bulk_update_mappings(Machine, mappings[i : i + STATUS_BATCH_SIZE])
+        db.session.bulk_insert_mappings(StatusEvent, events[i : i + STATUS_BATCH_SIZE])
+        db.session.commit()
@@ -0,0 +1,152 @@
+from collections import defaultdict, Counter
+from datetime import datetime, timedelta
+
+from sqlalchemy import func
+
+from app import (
+    db,
+    HISTORY_RAW_DAYS,
+    HISTORY_HOURLY_DAYS,
+    HISTORY_DAILY_DAYS,
+    HISTORY_COMPACT_INTERVAL,
+)
+from model.base import MachineStatus
+from model.status_event import StatusEvent, StatusSummary
+from utils.lease import claim
+
+COUNTERS = {
+    MachineStatus.POWER_ON: "power_on",
+    MachineStatus.POWER_OFF: "power_off",
+    MachineStatus.SUSPENDED: "suspended",
+}
+FIELDS = ["samples", *COUNTERS.values()]
+ROLLUP_BATCH_SIZE = 1000
+LEASE_NAME = "history-compaction"
+
+
+def delete_history(machine_id):
+    # SQLite doesn't enforce the ON DELETE CASCADE without the foreign_keys
+    # pragma, a machine reusing the id would inherit the history.
+    for model in (StatusEvent, StatusSummary):
+        model.query.filter(model.machine_id == machine_id).delete(
+            synchronize_session=False
+        )
+
+
+def truncate_hour(time):
+    return time.replace(minute=0, second=0, microsecond=0)
+
+
+def truncate_day(time):
+    return time.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _merge_summaries(period, counts):
+    if not counts:
+        return
+    starts = [start for _, start in counts]
+    existing = {
+        (s.machine_id, s.start): s
+        for s in StatusSummary.query.filter(
+            StatusSummary.period == period,
+            StatusSummary.start >= min(starts),
+            StatusSummary.start <= max(starts),
+        )
+    }
+    for (machine_id, start), counter in counts.items():
+        summary = existing.get((machine_id, start))
+        if summary is None:
+            summary = StatusSummary(
+                machine_id=machine_id,
+                period=period,
+                start=start,
+                **{field: 0 for field in FIELDS},
+            )
+            db.session.add(summary)
+        for field in FIELDS:
+            setattr(summary, field, getattr(summary, field) + counter[field])
+
+
+def rollup_events(cutoff):
+    counts = defaultdict(Counter)
+    events = db.session.query(
+        StatusEvent.machine_id, StatusEvent.time, StatusEvent.status
+    ).filter(StatusEvent.time < cutoff)
+    for machine_id, time, status in events.yield_per(ROLLUP_BATCH_SIZE):
+        counter = counts[(machine_id, truncate_hour(time))]
+        counter["samples"] += 1
+        if status in COUNTERS:
+            counter[COUNTERS[status]] += 1
+
+    _merge_summaries(StatusSummary.HOUR, counts)
+    StatusEvent.query.filter(StatusEvent.time < cutoff).delete(
+        synchronize_session=False
+    )
+
+
+def rollup_hours(cutoff):
+    counts = defaultdict(Counter)
+    hours = StatusSummary.query.filter(
+        StatusSummary.period == StatusSummary.HOUR, StatusSummary.start < cutoff
+    )
+    for hour in hours.yield_per(ROLLUP_BATCH_SIZE):
+        counter = counts[(hour.machine_id, truncate_day(hour.start))]
+        for field in FIELDS:
+            counter[field] += getattr(hour, field)
+
+    _merge_summaries(StatusSummary.DAY, counts)
+    hours.delete(synchronize_session=False)
+
+
+def compact(now=None):
+    # Raw events are rolled up into hours and hours into days once they
+    # get older than their retention, so every tier stays small. Counts are
+    # added to the summaries, so the rollup must never run twice over the
+    # same rows: it happens in the transaction holding the claim, which
+    # another worker can only take after it committed the deletes.
+    now = now or datetime.now()
+    if not claim(LEASE_NAME, HISTORY_COMPACT_INTERVAL, now, commit=False):
+        db.session.rollback()
+        return False
+    rollup_events(truncate_hour(now - timedelta(days=HISTORY_RAW_DAYS)))
+    rollup_hours(truncate_day(now - timedelta(days=HISTORY_HOURLY_DAYS)))
+    if HISTORY_DAILY_DAYS:
+        StatusSummary.query.filter(
+            StatusSummary.period == StatusSummary.DAY,
+            StatusSummary.start < now - timedelta(days=HISTORY_DAILY_DAYS),
+        ).delete(synchronize_session=False)
+    db.session.commit()
+    return True
+
+
+def uptime(machine_id, since, until):
+    # The tiers never overlap in time, so the counts of all of them add up.
+    totals = Counter()
+    events = (
+        db.session.query(StatusEvent.status, func.count())
+        .filter(
+            StatusEvent.machine_id == machine_id,
+            StatusEvent.time >= since,
+            StatusEvent.time < until,
+        )
+        .group_by(StatusEvent.status)
+    )
+    for status, count in events:
+        totals["samples"] += count
+        if status in COUNTERS:
+            totals[COUNTERS[status]] += count
+
+    summaries = db.session.query(
+        *[func.coalesce(func.sum(getattr(StatusSummary, f)), 0) for f in FIELDS]
+    ).filter(
+        StatusSummary.machine_id == machine_id,
+        StatusSummary.start >= since,
+        StatusSummary.start < until,
+    )
+    totals.update(dict(zip(FIELDS, summaries.one())))
+
+    result = {field: totals[field] for field in FIELDS}
+    result["uptime"] = (
+        totals["power_on"] / totals["samples"] if totals["samples"] else None
+    )
+    return result
@@ -0,0 +1,211 @@
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager, nullcontext
+from os import O_WRONLY, O_CREAT, O_EXCL, open as open_file, write, close
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+from threading import Lock
+from time import monotonic, sleep
+from urllib.parse import urlencode
+
+try:
+    import libvirt
+except ImportError:
+    libvirt = None
+
+from app import app, SSH_KNOWN_HOSTS, SSH_AUTO_ADD_HOST_KEYS
+from model.base import MachineStatus
+from model.credential import SshCredential
+from model.hardware_features import LibvirtGuest
+from model.software_platform import LinuxPlatform
+from utils.ssh import credential_digest
+
+STATE_POLL_INTERVAL = 1
+
+if libvirt is not None:
+    DOMAIN_STATES = {
+        libvirt.VIR_DOMAIN_RUNNING: MachineStatus.POWER_ON,
+        libvirt.VIR_DOMAIN_BLOCKED: MachineStatus.POWER_ON,
+        libvirt.VIR_DOMAIN_SHUTDOWN: MachineStatus.POWER_ON,
+        libvirt.VIR_DOMAIN_PAUSED: MachineStatus.SUSPENDED,
+        libvirt.VIR_DOMAIN_PMSUSPENDED: MachineStatus.SUSPENDED,
+        libvirt.VIR_DOMAIN_SHUTOFF: MachineStatus.POWER_OFF,
+        libvirt.VIR_DOMAIN_CRASHED: MachineStatus.POWER_OFF,
+    }
+
+_connections = {}
+_connection_locks = defaultdict(Lock)
+_connections_lock = Lock()
+
+
+class HypervisorUnavailable(ConnectionError):
+    pass
+
+
+@contextmanager
+def key_file(credential):
+    # libvirt hands the key to ssh as a path. The file exists only while a
+    # connection is being opened, in a directory only this user can read.
+    directory = mkdtemp(prefix="dom-key-")
+    try:
+        path = join(directory, "key")
+        fd = open_file(path, O_WRONLY | O_CREAT | O_EXCL, 0o600)
+        try:
+            write(fd, credential.key.encode())
+        finally:
+            close(fd)
+        yield path
+    finally:
+        rmtree(directory, ignore_errors=True)
+
+
+def host_uri(host, keyfile=None):
+    credential = host.credential
+    base = f"{credential.username}@{host.hostname}/system"
+    secret = getattr(credential, "secret", None)
+    if isinstance(credential, SshCredential) and not secret:
+        params = {"keyfile": keyfile}
+        if SSH_AUTO_ADD_HOST_KEYS:
+            params["no_verify"] = 1
+        return f"qemu+ssh://{base}?{urlencode(params, safe='/')}"
+
+    # The ssh binary can't be given a password or a passphrase, libssh2
+    # asks for them through the auth callback instead.
+    params = {"known_hosts_verify": "auto" if SSH_AUTO_ADD_HOST_KEYS else "normal"}
+    if SSH_KNOWN_HOSTS:
+        params["known_hosts"] = SSH_KNOWN_HOSTS
+    if isinstance(credential, SshCredential):
+        params |= {"sshauth": "privkey", "keyfile": keyfile}
+    else:
+        params["sshauth"] = "password"
+    return f"qemu+libssh2://{base}?{urlencode(params, safe='/')}"
+
+
+def _open(host):
+    credential = host.credential
+
+    def answer(credentials, _):
+        for item in credentials:
+            if item[0] == libvirt.VIR_CRED_AUTHNAME:
+                item[4] = credential.username
+            else:
+                item[4] = getattr(credential, "secret", None)
+        return 0
+
+    auth = [
+        [
+            libvirt.VIR_CRED_AUTHNAME,
+            libvirt.VIR_CRED_PASSPHRASE,
+            libvirt.VIR_CRED_NOECHOPROMPT,
+        ],
+        answer,
+        None,
+    ]
+    if isinstance(credential, SshCredential):
+        keys = key_file(credential)
+    else:
+        keys = nullcontext()
+    try:
+        with keys as keyfile:
+            return libvirt.openAuth(host_uri(host, keyfile), auth, 0)
+    except libvirt.libvirtError as e:
+        raise HypervisorUnavailable(f"Can't connect to {host.hostname}: {e}")
+
+
+def connection(host):
+    # One connection per hypervisor is shared by all threads, libvirt
+    # connections are thread-safe. Opening one only holds up the threads
+    # waiting for the same hypervisor.
+    key = (host.hostname, credential_digest(host.credential))
+    with _connections_lock:
+        lock = _connection_locks[key]
+    with lock:
+        conn = _connections.get(key)
+        if (conn is None) or (not conn.isAlive()):
+            conn = _connections[key] = _open(host)
+        return conn
+
+
+def group_guests(machines):
+    groups, others = {}, []
+    for machine in machines:
+        guest = machine.hardware_features
+        if (libvirt is not None) and isinstance(guest, LibvirtGuest):
+            groups.setdefault(guest.host_id, {})[machine.id] = str(guest.vm_uuid)
+        else:
+            others.append(machine.id)
+    return groups, others
+
+
+def domain_states(conn):
+    return {
+        domain.UUIDString(): DOMAIN_STATES.get(domain.state()[0])
+        for domain in conn.listAllDomains()
+    }
+
+
+def guest_statuses(host, guests):
+    states = domain_states(connection(host))
+    return {id: states.get(vm_uuid) for id, vm_uuid in guests.items()}
+
+
+def change_guest_statuses(host, guests, target_status, timeout):
+    conn = connection(host)
+    states = domain_states(conn)
+    for vm_uuid in guests.values():
+        status = states.get(vm_uuid)
+        if status in (None, target_status):
+            continue
+        domain = conn.lookupByUUIDString(vm_uuid)
+        if target_status == MachineStatus.POWER_ON:
+            if status == MachineStatus.SUSPENDED:
+                domain.resume()
+            else:
+                domain.create()
+        elif target_status == MachineStatus.POWER_OFF:
+            domain.shutdown()
+        elif target_status == MachineStatus.SUSPENDED:
+            domain.suspend()
+
+    # Shutdown is asynchronous, keep reading all domain states in one call
+    # until every guest got there or the time is up.
+    deadline = monotonic() + timeout
+    while True:
+        statuses = {id: states.get(vm_uuid) for id, vm_uuid in guests.items()}
+        if all(s in (None, target_status) for s in statuses.values()):
+            return statuses
+        if monotonic() + STATE_POLL_INTERVAL > deadline:
+            return statuses
+        sleep(STATE_POLL_INTERVAL)
+        states = domain_states(conn)
+
+
+def _run_for_host(func, host_id, guests):
+    with app.app_context():
+        started = monotonic()
+        try:
+            statuses = func(LinuxPlatform.query.get(host_id), guests)
+            return {id: (statuses[id], None, monotonic() - started) for id in guests}
+        except Exception as e:
+            return {id: (None, e, monotonic() - started) for id in guests}
+
+
+def run_on_hosts(groups, func, workers, timeout):
+    if not groups:
+        return {}
+
+    results = {}
+    executor = ThreadPoolExecutor(max_workers=min(workers, len(groups)))
+    futures = {
+        executor.submit(_run_for_host, func, host_id, guests): guests
+        for host_id, guests in groups.items()
+    }
+    done, pending = wait(futures, timeout=timeout)
+    for future in done:
+        results |= future.result()
+    for future in pending:
+        error = TimeoutError(f"No answer after {timeout} seconds")
+        results |= {id: (None, error, timeout) for id in futures[future]}
+    executor.shutdown(wait=False)
+    return results
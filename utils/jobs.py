@@ -0,0 +1,593 @@
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from enum import Enum
+from logging import exception
+from threading import Condition, Lock
+from time import monotonic
+from uuid import uuid4
+
+from sqlalchemy import or_, select
+
+from app import (
+    app,
+    db,
+    JOB_WORKERS,
+    JOB_HISTORY,
+    JOB_OUTPUT_LINES,
+    JOB_STALE_AFTER,
+    BATCH_STEPS,
+)
+from model.job import JobRecord, JobStepRecord
+from model.machine import Machine
+from utils import execute_operations
+from utils.batch import SHELL_OPS, find_batch_platform, split_batches, run_batch
+from utils.fleet import MachineResult, run_on_machines, save_statuses
+from utils.metrics import registry, timed_operation, operation_seconds
+from utils.reachability import reachability
+
+jobs_table = JobRecord.__table__
+steps_table = JobStepRecord.__table__
+PRUNE_BATCH_SIZE = 500
+
+
+class JobStatus(Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+
+class OutputBuffer:
+    # A ring buffer of job events, readers that fall behind skip the events
+    # which were already pushed out instead of the job keeping everything.
+    def __init__(self, size):
+        self._events = deque(maxlen=size)
+        self._next_id = 0
+        self._closed = False
+        self._changed = Condition()
+
+    def append(self, event, data):
+        with self._changed:
+            self._events.append((self._next_id, event, data))
+            self._next_id += 1
+            self._changed.notify_all()
+
+    def close(self):
+        with self._changed:
+            self._closed = True
+            self._changed.notify_all()
+
+    def read(self, after, timeout):
+        with self._changed:
+            if (not self._closed) and (self._next_id <= after + 1):
+                self._changed.wait(timeout)
+            events = [e for e in self._events if e[0] > after]
+            first_id = self._events[0][0] if self._events else self._next_id
+            return events, max(0, first_id - after - 1), self._closed
+
+
+def _write(*statements):
+    # Job state is written on its own short transaction, it is updated from
+    # job threads and from requests which have their own session open.
+    with db.engine.begin() as connection:
+        for statement in statements:
+            connection.execute(statement)
+
+
+def _save_job(job):
+    return (
+        jobs_table.update()
+        .where(jobs_table.c.id == job.id)
+        .values(
+            status=job.status.value,
+            started=job.started,
+            finished=job.finished,
+            updated=datetime.now(),
+        )
+    )
+
+
+def _job_row(job, parent_id=None):
+    return {
+        "id": job.id,
+        "parent_id": parent_id,
+        "machine_id": job.machine_id,
+        "name": job.name,
+        "status": job.status.value,
+        "created": job.created,
+        "started": job.started,
+        "finished": job.finished,
+        "updated": datetime.now(),
+    }
+
+
+class JobStep:
+    def __init__(self, index, op_name, argument):
+        self.index = index
+        self.op_name = op_name
+        self.argument = argument
+        self.status = JobStatus.QUEUED
+        self.output = None
+        self.error = None
+        self.duration = None
+
+    @classmethod
+    def from_row(cls, row):
+        step = cls(row.index, row.op_name, row.argument)
+        step.status = JobStatus(row.status)
+        step.output = row.output
+        step.error = row.error
+        step.duration = row.duration
+        return step
+
+    def to_row(self, job_id):
+        return {"job_id": job_id, "index": self.index, **self.to_dict()}
+
+    def to_dict(self):
+        return {
+            "op_name": self.op_name,
+            "argument": self.argument,
+            "status": self.status.value,
+            "output": self.output,
+            "error": self.error,
+            "duration": self.duration,
+        }
+
+    def to_event(self):
+        return {
+            "step": self.index,
+            "op_name": self.op_name,
+            "argument": self.argument,
+            "status": self.status.value,
+            "error": self.error,
+        }
+
+
+class Job:
+    children = ()
+
+    def __init__(self, machine_id, name, steps):
+        self.id = uuid4().hex
+        self.machine_id = machine_id
+        self.name = name
+        self.steps = [
+            JobStep(i, step["op_name"], step.get("argument"))
+            for i, step in enumerate(steps)
+        ]
+        self.log = OutputBuffer(JOB_OUTPUT_LINES)
+        self.status = JobStatus.QUEUED
+        self.created = datetime.now()
+        self.started = None
+        self.finished = None
+
+    @classmethod
+    def from_row(cls, row, steps):
+        job = cls(row.machine_id, row.name, [])
+        job.id = row.id
+        job.steps = [JobStep.from_row(step) for step in steps]
+        job.status = JobStatus(row.status)
+        job.created = row.created
+        job.started = row.started
+        job.finished = row.finished
+        job.log.close()
+        return job
+
+    @property
+    def is_finished(self):
+        return self.status in (JobStatus.DONE, JobStatus.FAILED)
+
+    def save(self):
+        _write(_save_job(self))
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "machine_id": self.machine_id,
+            "name": self.name,
+            "status": self.status.value,
+            "created": self.created.isoformat(),
+            "started": self.started.isoformat() if self.started else None,
+            "finished": self.finished.isoformat() if self.finished else None,
+            "steps": [step.to_dict() for step in self.steps],
+        }
+
+    def run(self):
+        with app.app_context():
+            machine = Machine.query.get(self.machine_id)
+            if machine is None:
+                self.log.close()
+                raise LookupError(f"Machine {self.machine_id} no longer exists")
+            self.execute(machine)
+
+    def execute(self, machine):
+        try:
+            self._execute(machine)
+        except Exception:
+            self.status = JobStatus.FAILED
+            self.finished = datetime.now()
+            raise
+        finally:
+            self.save()
+            self.log.append("end", {"status": self.status.value})
+            self.log.close()
+
+    def _execute(self, machine):
+        self.status = JobStatus.RUNNING
+        self.started = datetime.now()
+        self.save()
+        platform = find_batch_platform(machine) if BATCH_STEPS else None
+        for batch in split_batches(self.steps):
+            # Shell steps go through the batch runner even alone, it streams
+            # their output while they run.
+            if (platform is not None) and (batch[0].op_name in SHELL_OPS):
+                self._run_batch(platform, batch)
+            else:
+                self._run_step(machine, batch[0])
+            if self.status == JobStatus.FAILED:
+                break
+
+        save_statuses({machine.id: machine.get_status()})
+        if self.status == JobStatus.RUNNING:
+            self.status = JobStatus.DONE
+        self.finished = datetime.now()
+
+    def _output(self, index, line):
+        self.log.append("output", {"step": index, "line": line})
+
+    def _step_changed(self, step):
+        self.log.append("step", step.to_event())
+        _write(
+            steps_table.update()
+            .where(steps_table.c.job_id == self.id, steps_table.c.index == step.index)
+            .values(
+                status=step.status.value,
+                output=step.output,
+                error=step.error,
+                duration=step.duration,
+            ),
+            jobs_table.update()
+            .where(jobs_table.c.id == self.id)
+            .values(updated=datetime.now()),
+        )
+
+    def _run_step(self, machine, step):
+        step.status = JobStatus.RUNNING
+        self._step_changed(step)
+        started = monotonic()
+        try:
+            provider = reachability.operation_provider(machine, step.op_name)
+            name = provider.PROVIDER_NAME if provider else "unknown"
+            with timed_operation(name, step.op_name):
+                output = execute_operations(
+                    machine, [{"op_name": step.op_name, "argument": step.argument}]
+                )
+            if output is not None:
+                lines = deque(str(output).splitlines(), maxlen=JOB_OUTPUT_LINES)
+                for line in lines:
+                    self._output(step.index, line)
+                step.output = "\n".join(lines)
+            step.status = JobStatus.DONE
+            if not reachability.is_probed(provider):
+                # It may have powered the machine on.
+                reachability.forget_machine(machine)
+        except Exception as e:
+            step.error = str(e) or type(e).__name__
+            step.status = JobStatus.FAILED
+            self.status = JobStatus.FAILED
+        finally:
+            step.duration = monotonic() - started
+            self._step_changed(step)
+
+    def _run_batch(self, platform, steps):
+        for step in steps:
+            step.status = JobStatus.RUNNING
+            self._step_changed(step)
+        started = monotonic()
+        try:
+            results, exit_status = run_batch(
+                platform,
+                [step.argument for step in steps],
+                lambda i, line: self._output(steps[i].index, line),
+                JOB_OUTPUT_LINES,
+            )
+        except Exception as e:
+            for step in steps:
+                step.status = JobStatus.FAILED
+                step.error = str(e) or type(e).__name__
+                step.duration = monotonic() - started
+                self._step_changed(step)
+            self.status = JobStatus.FAILED
+            return
+
+        stopped = False
+        for step, result in zip(steps, results):
+            if (result is None) and stopped:
+                # The script stops at the first failing step, the ones after
+                # it are never started.
+                step.status = JobStatus.QUEUED
+                self._step_changed(step)
+                continue
+            if result is None:
+                # Anything else without a result means the connection or sh
+                # died before the script got to the end.
+                step.error = "Batch terminated before step ran"
+                if exit_status != -1:
+                    step.error += f" (exit status {exit_status})"
+                step.status = JobStatus.FAILED
+                self.status = JobStatus.FAILED
+                self._step_changed(step)
+                continue
+            step.output = result.output
+            step.duration = result.duration
+            operation_seconds.observe(
+                result.duration, provider=platform.PROVIDER_NAME, op=step.op_name
+            )
+            if result.exit_code == 0:
+                step.status = JobStatus.DONE
+            else:
+                step.error = f"Exited with status {result.exit_code}"
+                step.status = JobStatus.FAILED
+                self.status = JobStatus.FAILED
+                stopped = True
+            self._step_changed(step)
+
+
+class FleetJob:
+    machine_id = None
+    steps = ()
+
+    def __init__(self, name, machines, steps, workers, timeout):
+        self.id = uuid4().hex
+        self.name = name
+        self.workers = workers
+        self.timeout = timeout
+        self.children = [
+            Job(id, machine_name, steps) for id, machine_name in machines.items()
+        ]
+        self.results = {}
+        self.status = JobStatus.QUEUED
+        self.created = datetime.now()
+        self.started = None
+        self.finished = None
+
+    @classmethod
+    def from_row(cls, row, children, steps):
+        job = cls(row.name, {}, [], None, None)
+        job.id = row.id
+        job.children = [Job.from_row(child, steps[child.id]) for child in children]
+        job.results = {
+            child.machine_id: MachineResult(
+                child.machine_id, None, child.error, child.duration
+            )
+            for child in children
+            if child.duration is not None
+        }
+        job.status = JobStatus(row.status)
+        job.created = row.created
+        job.started = row.started
+        job.finished = row.finished
+        return job
+
+    @property
+    def is_finished(self):
+        return self.status in (JobStatus.DONE, JobStatus.FAILED)
+
+    def save(self):
+        _write(_save_job(self))
+
+    def is_success(self, child):
+        result = self.results.get(child.machine_id)
+        return (
+            (result is not None)
+            and (result.error is None)
+            and (child.status == JobStatus.DONE)
+        )
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "name": self.name,
+            "status": self.status.value,
+            "created": self.created.isoformat(),
+            "started": self.started.isoformat() if self.started else None,
+            "finished": self.finished.isoformat() if self.finished else None,
+            "done": len(self.results),
+            "total": len(self.children),
+            "machines": [self._child_to_dict(child) for child in self.children],
+        }
+
+    def _child_to_dict(self, child):
+        result = self.results.get(child.machine_id)
+        return {
+            "machine_id": child.machine_id,
+            "name": child.name,
+            "job_id": child.id,
+            "finished": result is not None,
+            "success": self.is_success(child),
+            "duration": result.duration if result else None,
+            "error": str(result.error) if (result and result.error) else None,
+        }
+
+    def run(self):
+        self.status = JobStatus.RUNNING
+        self.started = datetime.now()
+        self.save()
+        children = {child.machine_id: child for child in self.children}
+
+        def on_result(result):
+            self.results[result.machine_id] = result
+            _write(
+                jobs_table.update()
+                .where(jobs_table.c.id == children[result.machine_id].id)
+                .values(
+                    error=str(result.error) if result.error else None,
+                    duration=result.duration,
+                )
+            )
+
+        run_on_machines(
+            children,
+            lambda machine: children[machine.id].execute(machine),
+            self.workers,
+            self.timeout,
+            on_result=on_result,
+        )
+        if all(self.is_success(child) for child in self.children):
+            self.status = JobStatus.DONE
+        else:
+            self.status = JobStatus.FAILED
+        self.finished = datetime.now()
+        self.save()
+
+
+class JobQueue:
+    def __init__(self, workers, history):
+        self.history = history
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="job")
+        self._jobs = OrderedDict()
+        self._lock = Lock()
+
+    def submit(self, job):
+        with db.engine.begin() as connection:
+            connection.execute(
+                jobs_table.insert(),
+                [_job_row(job)] + [_job_row(child, job.id) for child in job.children],
+            )
+            steps = [
+                step.to_row(j.id) for j in (job, *job.children) for step in j.steps
+            ]
+            if steps:
+                connection.execute(steps_table.insert(), steps)
+        self._prune()
+        with self._lock:
+            self._jobs[job.id] = job
+            for child in job.children:
+                self._jobs[child.id] = child
+            self._forget_old_jobs()
+        self._executor.submit(self._run, job)
+        return job
+
+    def get(self, job_id):
+        # Jobs started by another worker are read back from the database,
+        # without their live output.
+        return self._jobs.get(job_id) or self.load(job_id)
+
+    def is_local(self, job_id):
+        return job_id in self._jobs
+
+    def load(self, job_id):
+        with db.engine.connect() as connection:
+            row = connection.execute(
+                jobs_table.select().where(jobs_table.c.id == job_id)
+            ).first()
+            if row is None:
+                return None
+            children = connection.execute(
+                jobs_table.select()
+                .where(jobs_table.c.parent_id == job_id)
+                .order_by(jobs_table.c.name)
+            ).all()
+            steps = defaultdict(list)
+            for step in connection.execute(
+                steps_table.select()
+                .where(steps_table.c.job_id.in_([job_id, *(c.id for c in children)]))
+                .order_by(steps_table.c.index)
+            ):
+                steps[step.job_id].append(step)
+        if row.machine_id is None:
+            return FleetJob.from_row(row, children, steps)
+        return Job.from_row(row, steps[row.id])
+
+    def is_busy(self, machine_id, now=None):
+        # A job that stopped reporting for so long was lost with its worker.
+        now = now or datetime.now()
+        with db.engine.connect() as connection:
+            busy = connection.execute(
+                select(jobs_table.c.id)
+                .where(
+                    jobs_table.c.machine_id == machine_id,
+                    jobs_table.c.status.in_(
+                        [JobStatus.QUEUED.value, JobStatus.RUNNING.value]
+                    ),
+                    jobs_table.c.updated > now - timedelta(seconds=JOB_STALE_AFTER),
+                )
+                .limit(1)
+            ).first()
+        return busy is not None
+
+    def count(self, status):
+        return sum(job.status == status for job in list(self._jobs.values()))
+
+    def _run(self, job):
+        try:
+            job.run()
+        except Exception:
+            job.status = JobStatus.FAILED
+            job.finished = datetime.now()
+            job.save()
+            exception("Job %s failed", job.id)
+
+    def _forget_old_jobs(self):
+        # Children of a fleet job are only forgotten together with it.
+        children = {child.id for job in self._jobs.values() for child in job.children}
+        finished = deque(
+            id
+            for id, job in self._jobs.items()
+            if job.is_finished and (id not in children)
+        )
+        while finished and (len(self._jobs) > self.history):
+            for child in self._jobs.pop(finished.popleft()).children:
+                self._jobs.pop(child.id, None)
+
+    def _prune(self, now=None):
+        # The database keeps as many finished jobs as the memory does, the
+        # children of a fleet job go together with it.
+        now = now or datetime.now()
+        with db.engine.begin() as connection:
+            old = (
+                connection.execute(
+                    select(jobs_table.c.id)
+                    .where(
+                        jobs_table.c.parent_id.is_(None),
+                        or_(
+                            jobs_table.c.finished.isnot(None),
+                            jobs_table.c.updated
+                            < now - timedelta(seconds=JOB_STALE_AFTER),
+                        ),
+                    )
+                    .order_by(jobs_table.c.created.desc())
+                    .offset(self.history)
+                    .limit(PRUNE_BATCH_SIZE)
+                )
+                .scalars()
+                .all()
+            )
+            if not old:
+                return
+            children = select(jobs_table.c.id).where(jobs_table.c.parent_id.in_(old))
+            connection.execute(
+                steps_table.delete().where(
+                    or_(
+                        steps_table.c.job_id.in_(old),
+                        steps_table.c.job_id.in_(children),
+                    )
+                )
+            )
+            connection.execute(
+                jobs_table.delete().where(jobs_table.c.parent_id.in_(old))
+            )
+            connection.execute(jobs_table.delete().where(jobs_table.c.id.in_(old)))
+
+
+job_queue = JobQueue(JOB_WORKERS, JOB_HISTORY)
+registry.gauge(
+    "dom_jobs_queued",
+    "Jobs waiting for a worker.",
+    lambda: job_queue.count(JobStatus.QUEUED),
+)
+registry.gauge(
+    "dom_jobs_running",
+    "Jobs currently running.",
+    lambda: job_queue.count(JobStatus.RUNNING),
+)
@@ -0,0 +1,73 @@
+from atexit import register
+from datetime import datetime, timedelta
+from logging import exception
+from os import getpid
+from socket import gethostname
+
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
+
+from app import app, db
+from model.lease import Lease
+
+_held = set()
+
+
+def holder():
+    # Read on every call, workers forked from a preloaded app must not share
+    # the id of their parent.
+    return f"{gethostname()}:{getpid()}"
+
+
+def _take(name, duration, condition, now, commit):
+    if Lease.query.get(name) is None:
+        # The row is created already expired, so taking it is always the
+        # same conditional update.
+        db.session.add(Lease(name=name, holder="", expires=now))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+    taken = Lease.query.filter(Lease.name == name, condition).update(
+        {"holder": holder(), "expires": now + timedelta(seconds=duration)},
+        synchronize_session=False,
+    )
+    if commit:
+        db.session.commit()
+    return taken == 1
+
+
+def acquire(name, duration, now=None):
+    # Every worker runs the background loops, only the one holding the lease
+    # does the work. It is renewed by its holder and taken over by another
+    # worker only once it expired.
+    now = now or datetime.now()
+    taken = _take(
+        name, duration, or_(Lease.holder == holder(), Lease.expires <= now), now, True
+    )
+    if taken and not _held:
+        register(_release_held)
+    if taken:
+        _held.add(name)
+    return taken
+
+
+def _release_held():
+    # A process that exits, like a short flask command, hands its leases
+    # over at once instead of blocking the workers until they expire.
+    try:
+        with app.app_context():
+            Lease.query.filter(Lease.name.in_(_held), Lease.holder == holder()).update(
+                {"expires": datetime.now()}, synchronize_session=False
+            )
+            db.session.commit()
+    except Exception:
+        exception("Releasing leases failed")
+
+
+def claim(name, interval, now=None, commit=True):
+    # Succeeds at most once per interval across all workers, whoever asks.
+    # Without commit the row stays locked until the caller's transaction
+    # ends, and a rollback gives the claim back.
+    now = now or datetime.now()
+    return _take(name, interval, Lease.expires <= now, now, commit)
@@ -0,0 +1,200 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock
+from time import monotonic
+
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from utils.profiling import profiled
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class Metric:
+    TYPE = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = Lock()
+
+    def _key(self, labels):
+        return tuple(labels[name] for name in self.labels)
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} {self.TYPE}",
+        ]
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in sorted(values, key=lambda item: item[0]):
+            lines += self._render_value(key, value)
+        return lines
+
+    def _render_value(self, key, value):
+        return [f"{self.name}{_format_labels(self.labels, key)} {value}"]
+
+
+class Counter(Metric):
+    TYPE = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    TYPE = "gauge"
+
+    # Gauges are read from a callback when scraped, nothing is tracked
+    # between scrapes.
+    def __init__(self, name, description, callback):
+        super().__init__(name, description)
+        self.callback = callback
+
+    def render(self):
+        return [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} {self.TYPE}",
+            f"{self.name} {self.callback()}",
+        ]
+
+
+class Histogram(Metric):
+    TYPE = "histogram"
+
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def _render_value(self, key, counts):
+        lines, total = [], 0
+        bounds = [*self.buckets, "+Inf"]
+        for bound, count in zip(bounds, counts):
+            total += count
+            labels = _format_labels(self.labels, key, [("le", bound)])
+            lines.append(f"{self.name}_bucket{labels} {total}")
+        labels = _format_labels(self.labels, key)
+        lines.append(f"{self.name}_sum{labels} {counts[-1]}")
+        lines.append(f"{self.name}_count{labels} {total}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, description, labels=()):
+        return self.register(Counter(name, description, labels))
+
+    def gauge(self, name, description, callback):
+        return self.register(Gauge(name, description, callback))
+
+    def histogram(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, description, labels, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            try:
+                lines += metric.render()
+            except Exception:
+                continue
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+request_seconds = registry.histogram(
+    "dom_request_duration_seconds",
+    "Time spent handling HTTP requests.",
+    ["endpoint", "method", "status"],
+)
+request_queries = registry.histogram(
+    "dom_request_sql_queries",
+    "Number of SQL statements executed per HTTP request.",
+    ["endpoint"],
+    COUNT_BUCKETS,
+)
+operation_seconds = registry.histogram(
+    "dom_operation_duration_seconds",
+    "Time spent running machine operations.",
+    ["provider", "op"],
+)
+operation_errors = registry.counter(
+    "dom_operation_errors_total",
+    "Machine operations which raised an error.",
+    ["provider", "op"],
+)
+
+
+@contextmanager
+def timed_operation(provider, op):
+    started = monotonic()
+    try:
+        with profiled("provider"):
+            yield
+    except Exception:
+        operation_errors.inc(provider=provider, op=op)
+        raise
+    finally:
+        operation_seconds.observe(monotonic() - started, provider=provider, op=op)
+
+
+def instrument_app(app):
+    @app.before_request
+    def start_request_metrics():
+        g.metrics_started = monotonic()
+        g.sql_queries = 0
+
+    @app.after_request
+    def observe_request_metrics(response):
+        if "metrics_started" in g:
+            endpoint = request.endpoint or "none"
+            request_seconds.observe(
+                monotonic() - g.metrics_started,
+                endpoint=endpoint,
+                method=request.method,
+                status=response.status_code,
+            )
+            request_queries.observe(g.sql_queries, endpoint=endpoint)
+        return response
+
+    # Only statements run while handling a request are counted, background
+    # workers have no request context.
+    @event.listens_for(Engine, "before_cursor_execute")
+    def count_query(*args):
+        if has_request_context() and ("sql_queries" in g):
+            g.sql_queries += 1
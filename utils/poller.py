@@ -0,0 +1,84 @@
+from datetime import datetime, timedelta
+from logging import exception
+from threading import Thread
+from time import sleep
+
+from sqlalchemy import func
+
+from app import app, db, POLL_INTERVAL, POLL_WORKERS, POLL_TIMEOUT, LEADER_LEASE
+from model.machine import Machine
+from utils.fleet import get_statuses, save_statuses
+from utils.history import compact
+from utils.lease import acquire
+
+LEASE_NAME = "status-poller"
+
+
+class StatusPoller:
+    def __init__(self, interval, workers, timeout, lease):
+        self.interval = interval
+        self.workers = workers
+        self.timeout = timeout
+        # A sweep and the pause after it must fit in one lease.
+        self.lease = max(lease, 2 * interval + timeout)
+        # Machines whose status call from an earlier sweep hasn't returned.
+        self._in_flight = set()
+        self._thread = None
+
+    @property
+    def last_sweep(self):
+        # The sweep may run in another worker, the newest saved status tells
+        # when it last got through.
+        return db.session.query(func.max(Machine.last_status_time)).scalar()
+
+    @property
+    def stale_before(self):
+        # Statuses that missed two sweeps in a row are shown as stale.
+        if not self.interval:
+            return None
+        return datetime.now() - timedelta(seconds=2 * self.interval)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = Thread(target=self._loop, name="status-poller", daemon=True)
+            self._thread.start()
+
+    def sweep(self):
+        with app.app_context():
+            machine_ids = [id for (id,) in db.session.query(Machine.id)]
+            results = get_statuses(
+                machine_ids, self.workers, self.timeout, self._in_flight
+            )
+            save_statuses({r.machine_id: r.value for r in results if r.error is None})
+        return results
+
+    def compact_history(self):
+        with app.app_context():
+            return compact()
+
+    def is_leader(self):
+        with app.app_context():
+            return acquire(LEASE_NAME, self.lease)
+
+    def _loop(self):
+        while True:
+            try:
+                leader = self.is_leader()
+            except Exception:
+                exception("Status poller lease check failed")
+                leader = False
+            if not leader:
+                sleep(self.interval)
+                continue
+            try:
+                self.sweep()
+            except Exception:
+                exception("Status sweep failed")
+            try:
+                self.compact_history()
+            except Exception:
+                exception("Status history compaction failed")
+            sleep(self.interval)
+
+
+status_poller = StatusPoller(POLL_INTERVAL, POLL_WORKERS, POLL_TIMEOUT, LEADER_LEASE)
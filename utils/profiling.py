@@ -0,0 +1,179 @@
+import json
+import marshal
+from collections import OrderedDict
+from contextlib import contextmanager
+from cProfile import Profile
+from logging import getLogger
+from random import random
+from threading import Lock
+from time import monotonic
+from uuid import uuid4
+
+from flask import g, request, has_request_context
+from jinja2 import Template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app import PROFILING, SLOW_REQUEST_MS, PROFILE_SAMPLE_RATE, PROFILE_STORE_SIZE
+from utils.auth import verify_user
+
+PROFILE_HEADER = "X-Dom-Profile"
+
+slow_log = getLogger("dom.slow_requests")
+
+
+class RequestProfile:
+    def __init__(self):
+        self.started = monotonic()
+        self.timings = {"sql": 0.0, "provider": 0.0, "render": 0.0}
+        self.counts = {"sql": 0, "provider": 0, "render": 0}
+        self.profiler = None
+        self.requested = False
+
+    def record(self, kind, seconds):
+        self.timings[kind] += seconds
+        self.counts[kind] += 1
+
+    def to_dict(self, total):
+        return {
+            "total_ms": round(total * 1000, 1),
+            **{f"{k}_ms": round(v * 1000, 1) for k, v in self.timings.items()},
+            **{f"{k}_count": v for k, v in self.counts.items()},
+        }
+
+
+def current_profile():
+    if has_request_context():
+        return g.get("profile")
+    return None
+
+
+@contextmanager
+def profiled(kind):
+    profile = current_profile()
+    if profile is None:
+        yield
+        return
+    started = monotonic()
+    try:
+        yield
+    finally:
+        profile.record(kind, monotonic() - started)
+
+
+class ProfiledTemplate(Template):
+    def render(self, *args, **kwargs):
+        with profiled("render"):
+            return super().render(*args, **kwargs)
+
+
+class ProfileStore:
+    def __init__(self, size):
+        self.size = size
+        self._profiles = OrderedDict()
+        self._lock = Lock()
+
+    def add(self, profiler, path):
+        profiler.create_stats()
+        profile_id = uuid4().hex
+        with self._lock:
+            self._profiles[profile_id] = (path, marshal.dumps(profiler.stats))
+            while len(self._profiles) > self.size:
+                self._profiles.popitem(last=False)
+        return profile_id
+
+    def get(self, profile_id):
+        return self._profiles.get(profile_id)
+
+    def list(self):
+        with self._lock:
+            return [(id, path) for id, (path, _) in self._profiles.items()]
+
+
+class RequestProfiler:
+    def __init__(self, always, slow_threshold, sample_rate, store_size):
+        self.always = always
+        self.slow_threshold = slow_threshold
+        self.sample_rate = sample_rate
+        self.store = ProfileStore(store_size)
+
+    def init_app(self, app):
+        app.jinja_env.template_class = ProfiledTemplate
+        app.before_request(self._start)
+        app.after_request(self._finish)
+
+        @event.listens_for(Engine, "before_cursor_execute")
+        def start_query(conn, *args):
+            if current_profile() is not None:
+                conn.info.setdefault("profile_started", []).append(monotonic())
+
+        @event.listens_for(Engine, "after_cursor_execute")
+        def finish_query(conn, *args):
+            profile = current_profile()
+            if (profile is not None) and conn.info.get("profile_started"):
+                profile.record("sql", monotonic() - conn.info["profile_started"].pop())
+
+    def _requested(self):
+        # Views check credentials only after this hook, the header is
+        # honoured for authenticated users alone. Anyone else could slow
+        # every request down and read its timings.
+        header = request.headers.get(PROFILE_HEADER, "")
+        credentials = request.authorization
+        if not (self.always and header and credentials):
+            return ""
+        if not verify_user(credentials.username, credentials.password):
+            return ""
+        return header
+
+    def _start(self):
+        if not self.always:
+            return
+        header = self._requested()
+        g.profile = RequestProfile()
+        g.profile.requested = bool(header)
+        # A full profile slows the request down a lot, it's only taken for
+        # a sample of requests or when asked for explicitly.
+        if (header == "cprofile") or (random() < self.sample_rate):
+            profiler = Profile()
+            try:
+                profiler.enable()
+                g.profile.profiler = profiler
+            except ValueError:
+                # Another request is already being profiled.
+                pass
+
+    def _finish(self, response):
+        profile = g.pop("profile", None)
+        if profile is None:
+            return response
+        total = monotonic() - profile.started
+        if profile.profiler is not None:
+            profile.profiler.disable()
+            profile_id = self.store.add(profile.profiler, request.path)
+            if profile.requested:
+                response.headers["X-Dom-Profile-Id"] = profile_id
+
+        breakdown = profile.to_dict(total)
+        if profile.requested:
+            response.headers["Server-Timing"] = ", ".join(
+                f"{kind};dur={breakdown[f'{kind}_ms']}"
+                for kind in ["sql", "provider", "render", "total"]
+            )
+        if total * 1000 >= self.slow_threshold:
+            slow_log.warning(
+                json.dumps(
+                    {
+                        "method": request.method,
+                        "path": request.full_path.rstrip("?"),
+                        "endpoint": request.endpoint,
+                        "status": response.status_code,
+                        **breakdown,
+                    }
+                )
+            )
+        return response
+
+
+request_profiler = RequestProfiler(
+    PROFILING, SLOW_REQUEST_MS, PROFILE_SAMPLE_RATE, PROFILE_STORE_SIZE
+)
@@ -0,0 +1,133 @@
+from concurrent.futures import ThreadPoolExecutor
+from socket import create_connection
+from threading import Lock
+from time import monotonic
+
+from app import REACH_PORTS, REACH_TIMEOUT, REACH_DOWN_TTL, REACH_WORKERS
+from model.base import MachineStatus
+from utils.metrics import registry
+
+
+class HostUnreachable(ConnectionError):
+    pass
+
+
+class ReachabilityChecker:
+    # Only failures are remembered, a host that answered is probed again
+    # next time, so it's never reported up after it went down.
+    def __init__(self, ports, timeout, down_ttl, workers):
+        self.ports = ports
+        self.timeout = timeout
+        self.down_ttl = down_ttl
+        self.workers = workers
+        self._down = {}
+        self._lock = Lock()
+
+    def port(self, platform):
+        return self.ports.get(getattr(platform, "PROVIDER_NAME", None))
+
+    def address(self, platform):
+        return (platform.hostname, self.port(platform))
+
+    def is_probed(self, platform):
+        return bool(getattr(platform, "hostname", None)) and (
+            self.port(platform) is not None
+        )
+
+    def _is_down(self, address):
+        with self._lock:
+            expires = self._down.get(address)
+            if expires is None:
+                return False
+            if expires > monotonic():
+                return True
+            del self._down[address]
+            return False
+
+    def probe(self, address):
+        if self._is_down(address):
+            return False
+        try:
+            create_connection(address, timeout=self.timeout).close()
+            return True
+        except OSError:
+            with self._lock:
+                self._down[address] = monotonic() + self.down_ttl
+            return False
+
+    def is_reachable(self, platform):
+        if not self.is_probed(platform):
+            return True
+        return self.probe(self.address(platform))
+
+    def unreachable(self, platforms):
+        addresses = {self.address(p) for p in platforms if self.is_probed(p)}
+        unknown = [a for a in addresses if not self._is_down(a)]
+        if len(unknown) > 1:
+            with ThreadPoolExecutor(min(self.workers, len(unknown))) as executor:
+                up = dict(zip(unknown, executor.map(self.probe, unknown)))
+        else:
+            up = {a: self.probe(a) for a in unknown}
+        return {a for a in addresses if not up.get(a, False)}
+
+    def forget(self, hostname=None):
+        with self._lock:
+            if hostname is None:
+                self._down.clear()
+            else:
+                for address in [a for a in self._down if a[0] == hostname]:
+                    del self._down[address]
+
+    @property
+    def down_count(self):
+        now = monotonic()
+        return sum(expires > now for expires in list(self._down.values()))
+
+    def check_machine(self, machine, target_status=None, down=None):
+        # Only machines reached through their operating system alone are
+        # checked, anything with hardware features may still be powered on
+        # or queried while the host is down. Such a host that doesn't answer
+        # is switched off: that's its status, and a POWER_OFF target is
+        # already met. Returns None when the machine has to be asked.
+        platforms = machine.software_platforms
+        if (machine.hardware_features is not None) or not platforms:
+            return
+        if not all(self.is_probed(p) for p in platforms):
+            return
+        if down is None:
+            down = self.unreachable(platforms)
+        if not all(self.address(p) in down for p in platforms):
+            return
+        if target_status in (None, MachineStatus.POWER_OFF):
+            return MachineStatus.POWER_OFF
+        hosts = ", ".join(sorted({p.hostname for p in platforms}))
+        raise HostUnreachable(f"Host {hosts} is not reachable")
+
+    def forget_machine(self, machine):
+        # Called once the machine may be up again, it's probed anew instead
+        # of failing until its hosts' down entries expire.
+        for platform in machine.software_platforms:
+            self.forget(platform.hostname)
+
+    def operation_provider(self, machine, op_name):
+        # The provider execute_operations runs the operation with, the first
+        # one offering it. A host which doesn't answer fails at once instead
+        # of after the connect timeout. Hardware features aren't probed,
+        # they don't need the operating system to be up.
+        for provider in machine.get_operation_providers():
+            if op_name not in provider.get_operations():
+                continue
+            if not self.is_reachable(provider):
+                raise HostUnreachable(f"Host {provider.hostname} is not reachable")
+            return provider
+        return None
+
+
+reachability = ReachabilityChecker(
+    REACH_PORTS, REACH_TIMEOUT, REACH_DOWN_TTL, REACH_WORKERS
+)
+registry.gauge(
+    "dom_unreachable_hosts",
+    "Hosts currently remembered as unreachable.",
+    lambda: reachability.down_count,
+)
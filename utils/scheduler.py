@@ -0,0 +1,179 @@
+from datetime import datetime, timedelta
+from logging import exception
+from threading import Thread
+from time import sleep
+from zlib import crc32
+
+from app import app, db, SCHEDULER_INTERVAL, SCHEDULE_RUN_DAYS, LEADER_LEASE
+from model.custom_operation import CustomOperation
+from model.machine import Machine
+from model.schedule import Schedule, ScheduleRun
+from utils.cron import CronSchedule
+from utils.jobs import Job, JobStatus, job_queue
+from utils.lease import acquire
+
+DISPATCH_TICK = 1
+LEASE_NAME = "scheduler"
+
+
+class ScheduledJob(Job):
+    def __init__(self, run_id, machine_id, name, steps):
+        super().__init__(machine_id, name, steps)
+        self.run_id = run_id
+
+    def run(self):
+        try:
+            super().run()
+        finally:
+            error = next((step.error for step in self.steps if step.error), None)
+            with app.app_context():
+                finish_run(
+                    self.run_id,
+                    "done" if self.status == JobStatus.DONE else "failed",
+                    error,
+                )
+
+
+def finish_run(run_id, status, error):
+    ScheduleRun.query.filter_by(id=run_id).update(
+        {"status": status, "error": error, "finished": datetime.now()},
+        synchronize_session=False,
+    )
+    db.session.commit()
+
+
+def jitter_offset(schedule_id, machine_id, jitter):
+    # Every machine gets its own stable slot in the jitter window, so a big
+    # fleet is spread evenly instead of randomly bunching up.
+    return crc32(f"{schedule_id}:{machine_id}".encode()) % (jitter + 1)
+
+
+def schedule_targets(schedule):
+    query = db.session.query(Machine.id, Machine.name)
+    if schedule.machine_id is not None:
+        return query.filter(Machine.id == schedule.machine_id).all()
+    return query.filter(
+        Machine.custom_operations.any(
+            CustomOperation.id == schedule.custom_operation_id
+        )
+    ).all()
+
+
+class Scheduler:
+    def __init__(self, interval, run_days, lease):
+        self.interval = interval
+        self.run_days = run_days
+        self.lease = max(lease, 2 * interval)
+        self.leader = False
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = Thread(target=self._loop, name="scheduler", daemon=True)
+            self._thread.start()
+
+    def check(self, now=None):
+        now = now or datetime.now()
+        with app.app_context():
+            due = Schedule.query.filter(
+                Schedule.enabled, Schedule.next_run <= now
+            ).all()
+            for schedule in due:
+                if not self._claim(schedule, now):
+                    db.session.rollback()
+                    continue
+                for machine_id, machine_name in schedule_targets(schedule):
+                    offset = jitter_offset(schedule.id, machine_id, schedule.jitter)
+                    due_at = now + timedelta(seconds=offset)
+                    db.session.add(
+                        ScheduleRun(
+                            schedule_id=schedule.id,
+                            machine_id=machine_id,
+                            machine_name=machine_name,
+                            status="pending",
+                            due_at=due_at,
+                            started=due_at,
+                        )
+                    )
+                # The runs are written in the transaction which moves
+                # next_run, they are never lost between the two.
+                db.session.commit()
+            ScheduleRun.query.filter(
+                ScheduleRun.started < now - timedelta(days=self.run_days)
+            ).delete(synchronize_session=False)
+            db.session.commit()
+
+    def dispatch(self, now=None):
+        now = now or datetime.now()
+        with app.app_context():
+            ready = (
+                ScheduleRun.query.filter(
+                    ScheduleRun.status == "pending", ScheduleRun.due_at <= now
+                )
+                .order_by(ScheduleRun.due_at)
+                .all()
+            )
+            for run in ready:
+                self._start_run(run, now)
+
+    def _claim(self, schedule, now):
+        # Should the lease change hands in the middle of a check, only the
+        # worker which moves next_run forward gets to start the runs.
+        claimed = Schedule.query.filter(
+            Schedule.id == schedule.id, Schedule.next_run == schedule.next_run
+        ).update(
+            {
+                "next_run": CronSchedule(schedule.cron).next_after(now),
+                "last_run": now,
+            },
+            synchronize_session=False,
+        )
+        return claimed == 1
+
+    def _start_run(self, run, now):
+        claimed = ScheduleRun.query.filter(
+            ScheduleRun.id == run.id, ScheduleRun.status == "pending"
+        ).update({"status": "running", "started": now}, synchronize_session=False)
+        db.session.commit()
+        if not claimed:
+            return
+        schedule = Schedule.query.get(run.schedule_id)
+        if (not schedule.enabled) or (Machine.query.get(run.machine_id) is None):
+            db.session.delete(run)
+            db.session.commit()
+            return
+        # The jobs of every worker are in the database, a run started by
+        # hand or by an earlier schedule counts wherever it runs.
+        if job_queue.is_busy(run.machine_id, now):
+            finish_run(
+                run.id, "skipped", "Previous run on this machine is still in progress"
+            )
+            return
+        job = ScheduledJob(
+            run.id, run.machine_id, run.machine_name, schedule.custom_operation.ops
+        )
+        run.job_id = job.id
+        db.session.commit()
+        job_queue.submit(job)
+
+    def _loop(self):
+        checked = None
+        while True:
+            try:
+                now = datetime.now()
+                if (checked is None) or (
+                    now - checked
+                ).total_seconds() >= self.interval:
+                    with app.app_context():
+                        self.leader = acquire(LEASE_NAME, self.lease, now)
+                    if self.leader:
+                        self.check(now)
+                    checked = now
+                if self.leader:
+                    self.dispatch(now)
+            except Exception:
+                exception("Scheduler tick failed")
+            sleep(DISPATCH_TICK)
+
+
+scheduler = Scheduler(SCHEDULER_INTERVAL, SCHEDULE_RUN_DAYS, LEADER_LEASE)
@@ -0,0 +1,128 @@
+from datetime import datetime
+
+from sqlalchemy import and_, or_
+
+from app import db
+from model.base import MachineStatus
+from model.machine import Machine
+
+FILTERS = ("name", "place", "status", "hardware", "platform", "hostname")
+SORTS = ("last_status_time", "-last_status_time")
+
+HardwareFeatures = Machine.hardware_features.property.mapper.class_
+SoftwarePlatform = Machine.software_platforms.property.mapper.class_
+
+# Every filter below is an equality or range lookup on one of these, or an
+# EXISTS on the child tables through machine_id.
+INDEXES = [
+    db.Index("ix_machines_place", Machine.place),
+    db.Index("ix_machines_last_status", Machine.last_status),
+    db.Index("ix_machines_last_status_time", Machine.last_status_time),
+    db.Index(
+        "ix_hardware_features_machine_type",
+        HardwareFeatures.machine_id,
+        HardwareFeatures.__mapper__.polymorphic_on,
+    ),
+    db.Index(
+        "ix_software_platforms_machine_type",
+        SoftwarePlatform.machine_id,
+        SoftwarePlatform.__mapper__.polymorphic_on,
+    ),
+    db.Index("ix_software_platforms_hostname", SoftwarePlatform.hostname),
+]
+
+
+def ensure_indexes():
+    # create_all() only creates indexes together with new tables.
+    for index in INDEXES:
+        index.create(db.engine, checkfirst=True)
+
+
+def _subtypes(base):
+    mapper = base.__mapper__
+    return {
+        m.class_.PROVIDER_NAME: m
+        for m in mapper.self_and_descendants
+        if m.polymorphic_identity is not None
+    }
+
+
+def _is_subtype(base, provider_name):
+    mapper = _subtypes(base).get(provider_name)
+    if mapper is None:
+        raise ValueError(f"Unknown type '{provider_name}'")
+    return base.__mapper__.polymorphic_on == mapper.polymorphic_identity
+
+
+def filter_machines(query, args):
+    if args.get("name"):
+        # A range instead of LIKE, so the unique index on name is used
+        # whatever the collation is.
+        prefix = args["name"]
+        query = query.filter(Machine.name >= prefix, Machine.name < prefix + "\uffff")
+    if args.get("place"):
+        query = query.filter(Machine.place == args["place"])
+    if args.get("status"):
+        try:
+            query = query.filter(Machine.last_status == MachineStatus[args["status"]])
+        except KeyError:
+            raise ValueError(f"Unknown status '{args['status']}'")
+    if args.get("hardware") == "none":
+        query = query.filter(~Machine.hardware_features.has())
+    elif args.get("hardware"):
+        query = query.filter(
+            Machine.hardware_features.has(
+                _is_subtype(HardwareFeatures, args["hardware"])
+            )
+        )
+    if args.get("platform"):
+        query = query.filter(
+            Machine.software_platforms.any(
+                _is_subtype(SoftwarePlatform, args["platform"])
+            )
+        )
+    if args.get("hostname"):
+        query = query.filter(
+            Machine.software_platforms.any(
+                SoftwarePlatform.hostname == args["hostname"]
+            )
+        )
+    return query
+
+
+def sort_machines(query, sort):
+    if not sort:
+        return query.order_by(Machine.id)
+    if sort not in SORTS:
+        raise ValueError(f"Unknown sort '{sort}'")
+    column = Machine.last_status_time
+    if sort.startswith("-"):
+        return query.order_by(column.desc().nullslast(), Machine.id)
+    return query.order_by(column.asc().nullsfirst(), Machine.id)
+
+
+def sort_cursor(machine):
+    time = machine.last_status_time
+    return f"{time.isoformat() if time else ''}_{machine.id}"
+
+
+def after_sort_cursor(query, sort, cursor):
+    # Keyset pagination on (last_status_time, id), machines without a
+    # status time come first in ascending order and last in descending.
+    time, _, id = cursor.rpartition("_")
+    try:
+        id = int(id)
+        time = datetime.fromisoformat(time) if time else None
+    except ValueError:
+        raise ValueError("Incorrect cursor")
+
+    column = Machine.last_status_time
+    same_time = column.is_(None) if time is None else column == time
+    after = and_(same_time, Machine.id > id)
+    if sort.startswith("-"):
+        if time is None:
+            return query.filter(after)
+        return query.filter(or_(column < time, after, column.is_(None)))
+    if time is None:
+        return query.filter(or_(after, column.isnot(None)))
+    return query.filter(or_(column > time, after))
@@ -0,0 +1,91 @@
+from datetime import datetime, timedelta
+from secrets import token_hex
+
+from flask.sessions import SessionInterface, SessionMixin
+from itsdangerous import Signer, BadSignature
+from werkzeug.datastructures import CallbackDict
+
+from app import db
+from model.session_draft import SessionDraft
+
+drafts = SessionDraft.__table__
+
+
+class DraftSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid or token_hex(16)
+        self.new = new
+        self.modified = False
+
+
+# Wizard drafts grow with every added step or platform, so session data
+# is kept in the database and the cookie only holds a signed draft id.
+class DraftSessionInterface(SessionInterface):
+    salt = "dom-session-draft"
+
+    def __init__(self, ttl):
+        self.ttl = timedelta(seconds=ttl)
+
+    def _signer(self, app):
+        return Signer(app.secret_key, salt=self.salt)
+
+    def open_session(self, app, request):
+        cookie = request.cookies.get(self.get_cookie_name(app))
+        if not cookie:
+            return DraftSession(new=True)
+        try:
+            sid = self._signer(app).unsign(cookie).decode()
+        except BadSignature:
+            return DraftSession(new=True)
+
+        # A separate connection keeps session I/O out of the transaction
+        # the view is using.
+        with db.engine.connect() as connection:
+            row = connection.execute(
+                drafts.select().where(
+                    drafts.c.id == sid, drafts.c.expires > datetime.now()
+                )
+            ).first()
+        if row is None:
+            return DraftSession(new=True)
+        return DraftSession(row.data, sid=sid)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if not session:
+            if session.modified and not session.new:
+                with db.engine.begin() as connection:
+                    connection.execute(
+                        drafts.delete().where(drafts.c.id == session.sid)
+                    )
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        if not session.modified:
+            return
+
+        now = datetime.now()
+        values = {"data": dict(session), "expires": now + self.ttl}
+        with db.engine.begin() as connection:
+            updated = connection.execute(
+                drafts.update().where(drafts.c.id == session.sid).values(**values)
+            )
+            if not updated.rowcount:
+                connection.execute(drafts.insert().values(id=session.sid, **values))
+                connection.execute(drafts.delete().where(drafts.c.expires < now))
+
+        response.set_cookie(
+            name,
+            self._signer(app).sign(session.sid).decode(),
+            httponly=self.get_cookie_httponly(app),
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+            domain=domain,
+            path=path,
+        )
@@ -0,0 +1,211 @@
+from collections import defaultdict
+from contextlib import contextmanager
+from hashlib import sha256
+from io import StringIO
+from os.path import exists
+from threading import Lock, Semaphore, Thread
+from time import monotonic, sleep
+
+from paramiko import SSHClient, AutoAddPolicy, RejectPolicy
+
+from app import (
+    SSH_MAX_PER_HOST,
+    SSH_IDLE_TIMEOUT,
+    SSH_KEEPALIVE,
+    SSH_CONNECT_TIMEOUT,
+    SSH_KNOWN_HOSTS,
+    SSH_AUTO_ADD_HOST_KEYS,
+    KEY_CACHE_SIZE,
+    KEY_CACHE_TTL,
+)
+from model.credential import SshCredential
+from utils.cache import MemoryCache
+from utils.metrics import registry
+
+# Parsed keys only live in memory, decrypting a passphrase-protected key
+# runs its KDF again every time. Entries are keyed by the credential's
+# content, so an edited key is picked up at once by every worker.
+key_cache = MemoryCache(maxsize=KEY_CACHE_SIZE, ttl=KEY_CACHE_TTL)
+GLOBAL_KNOWN_HOSTS = "/etc/ssh/ssh_known_hosts"
+
+
+def credential_digest(credential):
+    key = getattr(credential, "key", None) or ""
+    secret = getattr(credential, "secret", None) or ""
+    return sha256(f"{credential.username}\0{key}\0{secret}".encode()).hexdigest()
+
+
+def load_key(credential, secret):
+    key_class = SshCredential.KEY_TYPES[credential.key_type]
+    return key_class.from_private_key(StringIO(credential.key), password=secret)
+
+
+def connect_kwargs(credential):
+    kwargs = {"username": credential.username}
+    secret = getattr(credential, "secret", None)
+    if isinstance(credential, SshCredential):
+        kwargs["pkey"] = key_cache.get(
+            (credential.id, credential_digest(credential)),
+            lambda: load_key(credential, secret),
+        )
+    elif secret:
+        kwargs["password"] = secret
+    return kwargs
+
+
+class PooledConnection:
+    def __init__(self, client, generation):
+        self.client = client
+        self.generation = generation
+        self.last_used = monotonic()
+
+    @property
+    def is_active(self):
+        transport = self.client.get_transport()
+        return (transport is not None) and transport.is_active()
+
+
+class SshConnectionPool:
+    def __init__(
+        self,
+        max_per_host,
+        idle_timeout,
+        keepalive,
+        connect_timeout,
+        known_hosts=None,
+        auto_add_host_keys=False,
+    ):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        self.connect_timeout = connect_timeout
+        self.known_hosts = known_hosts
+        self.auto_add_host_keys = auto_add_host_keys
+        self._idle = defaultdict(list)
+        self._slots = defaultdict(lambda: Semaphore(self.max_per_host))
+        self._generations = defaultdict(int)
+        self._lock = Lock()
+        self._reaper = None
+
+    @contextmanager
+    def connection(self, hostname, credential, port=22):
+        # Workers which didn't see the credential change still stop reusing
+        # connections made with the old one.
+        key = (hostname, credential.id, credential_digest(credential))
+        with self._lock:
+            slot = self._slots[hostname]
+        slot.acquire()
+        try:
+            connection = self._take_idle(key) or self._connect(
+                hostname, port, credential
+            )
+            try:
+                yield connection.client
+            finally:
+                self._give_back(key, connection)
+        finally:
+            slot.release()
+
+    def invalidate(self, credential_id):
+        with self._lock:
+            self._generations[credential_id] += 1
+            for key in [key for key in self._idle if key[1] == credential_id]:
+                for connection in self._idle.pop(key):
+                    connection.client.close()
+
+    def evict_idle(self):
+        deadline = monotonic() - self.idle_timeout
+        with self._lock:
+            for key, connections in list(self._idle.items()):
+                for connection in connections:
+                    if connection.last_used < deadline:
+                        connection.client.close()
+                self._idle[key] = [c for c in connections if c.last_used >= deadline]
+                if not self._idle[key]:
+                    del self._idle[key]
+
+    @property
+    def idle_count(self):
+        return sum(len(connections) for connections in self._idle.values())
+
+    def _take_idle(self, key):
+        with self._lock:
+            connections = self._idle.get(key, [])
+            while connections:
+                connection = connections.pop()
+                if connection.is_active:
+                    return connection
+                connection.client.close()
+        return None
+
+    def _client(self):
+        client = SSHClient()
+        client.load_system_host_keys()
+        if exists(GLOBAL_KNOWN_HOSTS):
+            client.load_system_host_keys(GLOBAL_KNOWN_HOSTS)
+        if self.known_hosts:
+            # Keys accepted with auto-add are saved here, so a host is only
+            # trusted blindly the first time.
+            if not exists(self.known_hosts):
+                open(self.known_hosts, "a").close()
+            client.load_host_keys(self.known_hosts)
+        # Hosts with an unknown key are refused unless auto-add was asked for.
+        if self.auto_add_host_keys:
+            client.set_missing_host_key_policy(AutoAddPolicy())
+        else:
+            client.set_missing_host_key_policy(RejectPolicy())
+        return client
+
+    def _connect(self, hostname, port, credential):
+        with self._lock:
+            generation = self._generations[credential.id]
+        client = self._client()
+        client.connect(
+            hostname,
+            port=port,
+            timeout=self.connect_timeout,
+            allow_agent=False,
+            look_for_keys=False,
+            **connect_kwargs(credential),
+        )
+        client.get_transport().set_keepalive(self.keepalive)
+        self._start_reaper()
+        return PooledConnection(client, generation)
+
+    def _give_back(self, key, connection):
+        with self._lock:
+            # A credential edited while the connection was in use
+            # invalidates it, it must not be handed out again.
+            if connection.is_active and (
+                connection.generation == self._generations[key[1]]
+            ):
+                connection.last_used = monotonic()
+                self._idle[key].append(connection)
+                return
+        connection.client.close()
+
+    def _start_reaper(self):
+        with self._lock:
+            if self._reaper is None:
+                self._reaper = Thread(target=self._reap, name="ssh-reaper", daemon=True)
+                self._reaper.start()
+
+    def _reap(self):
+        while True:
+            sleep(self.idle_timeout)
+            self.evict_idle()
+
+
+ssh_pool = SshConnectionPool(
+    SSH_MAX_PER_HOST,
+    SSH_IDLE_TIMEOUT,
+    SSH_KEEPALIVE,
+    SSH_CONNECT_TIMEOUT,
+    SSH_KNOWN_HOSTS,
+    SSH_AUTO_ADD_HOST_KEYS,
+)
+registry.gauge(
+    "dom_ssh_idle_connections",
+    "Pooled SSH connections waiting to be reused.",
+    lambda: ssh_pool.idle_count,
+)
@@ -0,0 +1,107 @@
+import csv
+import json
+from io import StringIO, TextIOWrapper
+from itertools import chain
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+FORMATS = {
+    "csv": "text/csv",
+    "json": "application/json",
+    "yaml": "application/yaml",
+}
+EXTENSIONS = {
+    "csv": "csv",
+    "json": "json",
+    "jsonl": "json",
+    "yaml": "yaml",
+    "yml": "yaml",
+}
+
+
+def check_format(format):
+    if format not in FORMATS:
+        raise ValueError(f"Unknown format '{format}'")
+    if (format == "yaml") and (yaml is None):
+        raise ValueError("YAML support requires PyYAML to be installed")
+
+
+def format_from_filename(filename):
+    return EXTENSIONS.get((filename or "").rpartition(".")[2].lower())
+
+
+def _read_json(text):
+    first = text.readline()
+    if first.lstrip().startswith("["):
+        # A JSON array can't be parsed piece by piece without a streaming
+        # parser, JSON Lines can.
+        try:
+            records = json.loads(first + text.read())
+        except ValueError as e:
+            raise ValueError(f"Incorrect JSON: {e}")
+        if not isinstance(records, list):
+            raise ValueError("JSON must be an array or one object per line")
+        for number, record in enumerate(records, 1):
+            yield number, record, None
+        return
+
+    number = 0
+    for line in chain([first], text):
+        if not line.strip():
+            continue
+        number += 1
+        try:
+            yield number, json.loads(line), None
+        except ValueError as e:
+            yield number, None, f"Incorrect JSON: {e}"
+
+
+def read_records(stream, format):
+    # Yields (record number, record, error) so a broken record is reported
+    # without stopping the whole import.
+    check_format(format)
+    text = TextIOWrapper(stream, encoding="utf-8-sig", newline="")
+    if format == "csv":
+        for number, row in enumerate(csv.DictReader(text), 1):
+            yield number, row, None
+    elif format == "json":
+        yield from _read_json(text)
+    else:
+        number = 0
+        try:
+            for document in yaml.safe_load_all(text):
+                for record in document if isinstance(document, list) else [document]:
+                    number += 1
+                    yield number, record, None
+        except yaml.YAMLError as e:
+            raise ValueError(f"Incorrect YAML: {e}")
+
+
+def write_records(records, format, columns=None):
+    check_format(format)
+    if format == "csv":
+        buffer = StringIO()
+        writer = csv.DictWriter(buffer, columns, extrasaction="ignore")
+        writer.writeheader()
+        for record in records:
+            writer.writerow(record)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+    elif format == "json":
+        separator = "[\n"
+        for record in records:
+            yield separator + json.dumps(record)
+            separator = ",\n"
+        yield "[]\n" if separator == "[\n" else "\n]\n"
+    else:
+        empty = True
+        for record in records:
+            empty = False
+            yield yaml.safe_dump([record], sort_keys=False, allow_unicode=True)
+        if empty:
+            yield "[]\n"
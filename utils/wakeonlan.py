@@ -0,0 +1,45 @@
+from socket import socket, AF_INET, SOCK_DGRAM, SOL_SOCKET, SO_BROADCAST
+from time import monotonic, sleep
+
+from app import WOL_BROADCASTS, WOL_PORT, WOL_RETRIES
+from model.base import MachineStatus
+
+RETRY_INTERVAL = 0.5
+FIRST_PROBE_DELAY = 2
+MAX_PROBE_DELAY = 30
+
+
+def magic_packet(mac_address):
+    mac = bytes.fromhex(mac_address.replace(":", "").replace("-", ""))
+    if len(mac) != 6:
+        raise ValueError(f"Incorrect MAC address '{mac_address}'")
+    return b"\xff" * 6 + mac * 16
+
+
+def send_magic_packets(
+    mac_addresses, broadcasts=WOL_BROADCASTS, port=WOL_PORT, retries=WOL_RETRIES
+):
+    packets = [magic_packet(mac) for mac in set(mac_addresses)]
+    # UDP gives no delivery guarantee, the whole burst is repeated a few
+    # times instead of waiting on any single machine.
+    with socket(AF_INET, SOCK_DGRAM) as sock:
+        sock.setsockopt(SOL_SOCKET, SO_BROADCAST, 1)
+        for attempt in range(retries):
+            if attempt:
+                sleep(RETRY_INTERVAL)
+            for packet in packets:
+                for address in broadcasts:
+                    sock.sendto(packet, (address, port))
+    return len(packets)
+
+
+def wait_until_up(machine, deadline):
+    delay = FIRST_PROBE_DELAY
+    while True:
+        status = machine.get_status()
+        if status == MachineStatus.POWER_ON:
+            return status
+        if monotonic() + delay > deadline:
+            return status
+        sleep(delay)
+        delay = min(delay * 2, MAX_PROBE_DELAY)